@@ -0,0 +1,264 @@
+"""run_benchmarks.py
+
+Measure the throughput of the parser, the loaders, and the rasterizer, save
+the results as JSON, and compare them with a baseline.
+
+Measured on a data folder, final_data by default:
+    - scan: seconds to construct a DicomContourParser
+    - parse_dicom_file, parse_contour_file and parse_contour_array: files
+      per second; the loaders use parse_contour_array
+    - poly_to_mask: microseconds per contour
+    - iterate_<loader>: slices per second of one random_shuffled_iterator
+      epoch, the peak RSS of the process running it, and the peak RSS of the
+      largest of its worker processes
+Each iterator benchmark runs in a fresh process, so that its peak RSS is its
+own.
+
+With --baseline, every metric that is worse than the baseline by more than
+the tolerance is reported, and the exit status is 1.
+
+usage:
+python benchmarks/run_benchmarks.py [--data /path/to/data/folder]
+    [--synthetic NUM_PATIENTS] [--output results.json]
+    [--baseline baseline.json] [--tolerance 0.2]
+"""
+
+import sys
+import json
+import glob
+import platform
+import argparse
+import tempfile
+import multiprocessing
+import os.path as opath
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+HERE = opath.dirname(opath.realpath(__file__))
+# the package is imported from the repository root without installing it,
+# and synthetic from this folder, whether run as a script or with -m
+for path in (HERE, opath.dirname(HERE)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import dicom_contour_parser
+from dicom_contour_parser import DicomContourParser, parsing
+from synthetic import make_synthetic
+
+
+REPEATS = 3
+# files and contours timed by the per-file benchmarks
+SAMPLE_SIZE = 200
+BATCH_SIZE = 32
+LOADERS = {
+    'sync': {},
+    'thread': {'async_load': True, 'loader': 'thread'},
+    'process': {'async_load': True, 'loader': 'process'},
+}
+
+
+def best_of(func, repeats=REPEATS):
+    """Run func repeatedly and return the shortest wall time
+    """
+    lapses = []
+    for _ in range(repeats):
+        st = perf_counter()
+        func()
+        lapses.append(perf_counter() - st)
+    return min(lapses)
+
+
+def metric(value, unit, higher_is_better):
+    """Build the JSON entry of one measurement
+    """
+    return {'value': value, 'unit': unit,
+            'higher_is_better': higher_is_better}
+
+
+def peak_rss_bytes(children=False):
+    """Get the peak resident set size of this process, or of the largest of
+    its terminated child processes
+    """
+    import resource
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _sample(filenames, size=SAMPLE_SIZE):
+    """Pick up to size files spread evenly over a sorted list
+    """
+    filenames = sorted(filenames)
+    if len(filenames) <= size:
+        return filenames
+    return [filenames[i] for i in
+            np.linspace(0, len(filenames) - 1, size).astype(int)]
+
+
+def bench_scan(path_to_data):
+    """Time the construction of a parser, including the folder scan
+    """
+    return metric(best_of(lambda: DicomContourParser(path_to_data)),
+                  's', False)
+
+
+def bench_parsing(path_to_data):
+    """Time parse_dicom_file, parse_contour_file, parse_contour_array and
+    poly_to_mask
+    """
+    dicoms = _sample(glob.glob(opath.join(path_to_data, 'dicoms', '*',
+                                          '*.dcm')))
+    contours = _sample(glob.glob(opath.join(
+        path_to_data, 'contourfiles', '*', '*-contours', '*.txt')))
+    results = {}
+    lapse = best_of(lambda: [parsing.parse_dicom_file(f) for f in dicoms])
+    results['parse_dicom_file'] = metric(len(dicoms) / lapse, 'files/s', True)
+    lapse = best_of(lambda: [parsing.parse_contour_file(f) for f in contours])
+    results['parse_contour_file'] = metric(len(contours) / lapse, 'files/s',
+                                           True)
+    lapse = best_of(lambda: [parsing.parse_contour_array(f)
+                             for f in contours])
+    results['parse_contour_array'] = metric(len(contours) / lapse,
+                                            'files/s', True)
+    polygons = [parsing.parse_contour_array(f) for f in contours]
+    lapse = best_of(lambda: [parsing.poly_to_mask(p, 256, 256)
+                             for p in polygons])
+    results['poly_to_mask'] = metric(lapse / max(len(polygons), 1) * 1e6,
+                                     'us', False)
+    return results
+
+
+def _iterate_epoch(path_to_data, options, batch_size):
+    """Run one epoch in a worker process; see bench_iterator
+    """
+    with DicomContourParser(path_to_data, **options) as parser:
+        count = 0
+        st = perf_counter()
+        for chunk in parser.random_shuffled_iterator(batch_size, seed=0):
+            count += len(chunk)
+        lapse = perf_counter() - st
+    # the worker processes are shut down and waited for by now
+    return count / lapse, peak_rss_bytes(), peak_rss_bytes(children=True)
+
+
+def bench_iterator(path_to_data, loader, batch_size=BATCH_SIZE):
+    """Time one epoch of random_shuffled_iterator in a fresh process
+
+    :return: dictionary of the slices/s and peak RSS metrics; the worker
+             peak is 0 for loaders without worker processes
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        rate, peak, worker_peak = pool.submit(
+            _iterate_epoch, path_to_data, LOADERS[loader],
+            batch_size).result()
+    return {'iterate_{}'.format(loader): metric(rate, 'slices/s', True),
+            'iterate_{}_peak_rss'.format(loader): metric(
+                peak / 2 ** 20, 'MiB', False),
+            'iterate_{}_worker_peak_rss'.format(loader): metric(
+                worker_peak / 2 ** 20, 'MiB', False)}
+
+
+def run(path_to_data, loaders=tuple(LOADERS)):
+    """Run all benchmarks on a data folder.
+
+    :param path_to_data: path string to the data folder
+    :param loaders: names of the LOADERS to run the iterator benchmark with
+    :return: dictionary of the environment and the metrics
+    """
+    parser = DicomContourParser(path_to_data)
+    metrics = {'scan': bench_scan(path_to_data)}
+    metrics.update(bench_parsing(path_to_data))
+    for loader in loaders:
+        metrics.update(bench_iterator(path_to_data, loader))
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'package': opath.dirname(dicom_contour_parser.__file__),
+        },
+        'data': {'path': opath.abspath(path_to_data),
+                 'num_patients': len(parser.id_list),
+                 'num_records': len(parser.record_list)},
+        'metrics': metrics,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Find the metrics that got worse than the baseline.
+
+    :param results: dictionary returned by run
+    :param baseline: dictionary returned by run, e.g. loaded from JSON
+    :param tolerance: relative change allowed, e.g. 0.2 for 20%
+    :return: list of (name, baseline value, value, relative change) of the
+             regressed metrics; metrics missing on either side are skipped
+    """
+    regressions = []
+    for name, entry in sorted(results['metrics'].items()):
+        base = baseline['metrics'].get(name)
+        if base is None or not base['value']:
+            continue
+        change = entry['value'] / base['value'] - 1
+        worse = -change if entry['higher_is_better'] else change
+        if worse > tolerance:
+            regressions.append((name, base['value'], entry['value'], change))
+    return regressions
+
+
+def main(argv=None):
+    default_data = opath.join(HERE, '../final_data')
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    ap.add_argument('--data', default=default_data,
+                    help='data folder to benchmark, or the template of '
+                         '--synthetic')
+    ap.add_argument('--synthetic', type=int, metavar='NUM_PATIENTS',
+                    help='benchmark a synthetic folder of this many patients')
+    ap.add_argument('--loaders', default=','.join(LOADERS),
+                    help='comma separated loaders of the iterator benchmark')
+    ap.add_argument('--output', help='JSON file to write the results to')
+    ap.add_argument('--baseline', help='JSON file of earlier results')
+    ap.add_argument('--tolerance', type=float, default=0.2,
+                    help='relative slowdown allowed against the baseline')
+    args = ap.parse_args(argv)
+    loaders = [name for name in args.loaders.split(',') if name]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path_to_data = args.data
+        if args.synthetic is not None:
+            path_to_data = make_synthetic(args.data,
+                                          opath.join(tmpdir, 'data'),
+                                          args.synthetic)
+        results = run(path_to_data, loaders)
+    results['data']['synthetic'] = args.synthetic
+
+    print('{} patients, {} records'.format(results['data']['num_patients'],
+                                           results['data']['num_records']))
+    for name, entry in sorted(results['metrics'].items()):
+        print('{:34s} {:12.3f} {}'.format(name, entry['value'],
+                                          entry['unit']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['data']['num_records'] != results['data']['num_records']:
+            print('warning: the baseline was measured on {} records, the '
+                  'scan times are not comparable'.format(
+                      baseline['data']['num_records']))
+        regressions = compare(results, baseline, args.tolerance)
+        for name, base, value, change in regressions:
+            print('REGRESSION {}: {:.3f} -> {:.3f} ({:+.1%})'.format(
+                name, base, value, change))
+        if regressions:
+            return 1
+        print('no regressions beyond {:.0%}'.format(args.tolerance))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""synthetic.py
+
+Generate a synthetic data folder of any number of patients from a real one.
+
+Every synthetic patient is a copy of one patient of the source folder, cycled
+in link.csv order, with its own patient and original IDs. The DICOM and
+contour files are hard linked where the file system allows it, so even
+thousands of patients take little time and space.
+
+usage: python benchmarks/synthetic.py num_patients /path/to/output/folder
+                                      [/path/to/data/folder]
+"""
+
+import os
+import sys
+import csv
+import shutil
+import os.path as opath
+
+
+def _link(source, target):
+    """Hard link source to target, or copy it if links are not supported
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _copy_folder(source, target):
+    """Link or copy the files of a folder, without subfolders
+    """
+    os.makedirs(target, exist_ok=True)
+    with os.scandir(source) as it:
+        for entry in it:
+            if entry.is_file():
+                _link(entry.path, opath.join(target, entry.name))
+
+
+def make_synthetic(path_to_data, output, num_patients):
+    """Write a data folder of num_patients patients cloned from another one.
+
+    :param path_to_data: path string to the source data folder
+    :param output: path string to the folder to write, created if needed
+    :param num_patients: number of patients to write
+    :return: output
+    """
+    with open(opath.join(path_to_data, 'link.csv'), newline='') as f:
+        links = [(row['patient_id'], row['original_id'])
+                 for row in csv.DictReader(f)]
+    if not links:
+        raise ValueError('{} has no patients'.format(path_to_data))
+    rows = []
+    for k in range(num_patients):
+        pid, oid = links[k % len(links)]
+        new_pid, new_oid = 'SYN{:06d}'.format(k), 'SYN-{:06d}'.format(k)
+        _copy_folder(opath.join(path_to_data, 'dicoms', pid),
+                     opath.join(output, 'dicoms', new_pid))
+        for kind in ('i-contours', 'o-contours'):
+            source = opath.join(path_to_data, 'contourfiles', oid, kind)
+            target = opath.join(output, 'contourfiles', new_oid, kind)
+            if opath.isdir(source):
+                _copy_folder(source, target)
+            else:
+                os.makedirs(target, exist_ok=True)
+        rows.append((new_pid, new_oid))
+    with open(opath.join(output, 'link.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('patient_id', 'original_id'))
+        writer.writerows(rows)
+    return output
+
+
+if __name__ == '__main__':
+    make_synthetic(sys.argv[3] if len(sys.argv) > 3 else
+                   opath.join(opath.dirname(opath.realpath(__file__)),
+                              '../final_data'),
+                   sys.argv[2], int(sys.argv[1]))
@@ -1 +1,2 @@
 from .dicom_contour_parser import *
+from .packed import PackedDataset, compile_dataset
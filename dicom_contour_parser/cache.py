@@ -0,0 +1,182 @@
+"""cache.py
+
+This module provides an on-disk cache of parsed records. Each entry is a
+single binary file holding a small JSON header followed by the raw arrays, and
+is read back through memory mapping.
+
+An entry is keyed by the paths, modification times and sizes of its source
+files, so changing any source file makes the old entry unreachable. Such stale
+entries can be removed with SliceCache.prune.
+
+"""
+
+import os
+import json
+import struct
+import hashlib
+import tempfile
+import os.path as opath
+
+import numpy as np
+
+
+MAGIC = b'DCPCACHE'
+# part of every key, bump it whenever the entry layout or the parsed values
+# change so that old entries are no longer found
+VERSION = 2
+SUFFIX = '.slice'
+ALIGNMENT = 64
+
+
+def _source_stats(filenames):
+    """Describe the source files of an entry.
+
+    :param filenames: tuple of path strings, empty strings for missing files
+    :return: list of [path, mtime_ns, size] triples, with None for the stats
+             of missing files
+    """
+    sources = []
+    for filename in filenames:
+        if filename:
+            filename = opath.abspath(filename)
+            st = os.stat(filename)
+            sources.append([filename, st.st_mtime_ns, st.st_size])
+        else:
+            sources.append([filename, None, None])
+    return sources
+
+
+class SliceCache:
+    """A directory of cached records.
+
+    usage:
+    cache = SliceCache('/path/to/cache')
+    data = cache.get(filenames)
+    if data is None:
+        data = parse(filenames)
+        cache.put(filenames, data)
+    """
+
+    def __init__(self, cache_dir):
+        """Initialize with the cache directory, creating it if needed.
+
+        :param cache_dir: path string to the cache directory
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, sources):
+        """Get the entry file path for the given source stats
+        """
+        key = hashlib.sha1(json.dumps([VERSION, sources]).encode('utf-8'))\
+            .hexdigest()
+        return opath.join(self.cache_dir, key + SUFFIX)
+
+    def get(self, filenames):
+        """Read the entry of the given source files.
+
+        :param filenames: tuple of path strings of the source files
+        :return: dictionary of field values, with memory mapped arrays, or
+                 None if there is no up-to-date entry
+        """
+        try:
+            path = self._entry_path(_source_stats(filenames))
+            header, data_offset = self._read_header(path)
+        except (OSError, ValueError):
+            return None
+        # copy-on-write, so that consumers can modify the arrays in memory
+        mm = np.memmap(path, dtype=np.uint8, mode='c').view(np.ndarray)
+        values = header['values']
+        for name, (offset, shape, dtype) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            start = data_offset + offset
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            values[name] = mm[start:start + nbytes].view(dtype).reshape(shape)
+        return values
+
+    def put(self, filenames, data):
+        """Write the entry of the given source files.
+
+        :param filenames: tuple of path strings of the source files
+        :param data: a namedtuple of parsed values
+        """
+        sources = _source_stats(filenames)
+        arrays, values = {}, {}
+        offset = 0
+        for name, value in data._asdict().items():
+            if isinstance(value, np.ndarray):
+                offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+                arrays[name] = [offset, list(value.shape), value.dtype.str]
+                offset += value.nbytes
+            else:
+                values[name] = value
+        header = json.dumps({'sources': sources, 'arrays': arrays,
+                             'values': values}).encode('utf-8')
+        prefix_len = len(MAGIC) + 4 + len(header)
+        data_offset = (prefix_len + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        # write to a temporary file first, so that readers and concurrent
+        # writers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(MAGIC)
+                f.write(struct.pack('<I', len(header)))
+                f.write(header)
+                for name, value in data._asdict().items():
+                    if name in arrays:
+                        f.seek(data_offset + arrays[name][0])
+                        f.write(np.ascontiguousarray(value).tobytes())
+                f.truncate(data_offset + offset)
+            os.replace(tmp_path, self._entry_path(sources))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def _read_header(path):
+        """Read the header of an entry file.
+
+        :param path: path string to the entry file
+        :return: 2-tuple of the header dictionary and the offset of the array
+                 data
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a cache entry'.format(path))
+            header_len, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        prefix_len = len(MAGIC) + 4 + header_len
+        data_offset = (prefix_len + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        return header, data_offset
+
+    def entries(self):
+        """List the entry files in the cache directory.
+
+        :return: list of path strings
+        """
+        return [opath.join(self.cache_dir, f)
+                for f in os.listdir(self.cache_dir) if f.endswith(SUFFIX)]
+
+    def prune(self):
+        """Remove entries whose source files changed or disappeared.
+
+        :return: number of removed entries
+        """
+        removed = 0
+        for path in self.entries():
+            try:
+                header, _ = self._read_header(path)
+                sources = header['sources']
+                stale = _source_stats([s[0] for s in sources]) != sources
+            except (OSError, ValueError):
+                stale = True
+            if stale:
+                os.unlink(path)
+                removed += 1
+        return removed
+
+    def clear(self):
+        """Remove all entries.
+        """
+        for path in self.entries():
+            os.unlink(path)
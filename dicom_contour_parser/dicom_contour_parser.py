@@ -8,16 +8,28 @@ date: 2017-09-23
 
 """
 
+import asyncio
 import csv
 import os
 import re
-import random
+import time
 import numpy as np
 import os.path as opath
-from threading import Thread
-from collections import namedtuple
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from functools import partial
+from threading import Condition, RLock
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, as_completed, wait)
 
+from . import instrumentation
 from . import parsing
+from . import samplers
+from . import shared_slots
+from .cache import SliceCache
+from .scan_index import ScanIndex, folder_mtimes
+from .memory_cache import MemoryCache, data_nbytes
+from .masks import PackedMask, compact_masks, empty_mask
 
 
 class InvalidDataFolder(Exception):
@@ -28,126 +40,1114 @@ RecordData = namedtuple('RecordData', ['dicom', 'ic_mask', 'oc_mask',
                                        'ic_path', 'oc_path'])
 
 
-def _parse_dicom_and_contour_files(filenames):
+# bit masks of the RecordData fields, for loading only some of them
+FIELD_BITS = dict((name, 1 << k) for k, name in enumerate(RecordData._fields))
+ALL_FIELDS = (1 << len(RecordData._fields)) - 1
+
+
+# loading states of the rows of a RecordTable
+NOT_LOADED, LOADING, LOADED, EVICTED = range(4)
+
+
+ScanReport = namedtuple('ScanReport', ['num_patients', 'num_skipped',
+                                       'num_scanned', 'num_records',
+                                       'seconds'])
+
+
+class StackedBatch:
+    """A batch of records stacked into contiguous (B, H, W) arrays.
+
+    Slices smaller than the largest one of the batch are zero-padded at the
+    bottom and on the right, and shapes holds their original (rows, cols).
+    The arrays are reused by the next batch of the same iterator, so they are
+    only valid until the next batch is requested and must be copied to be
+    kept.
+    """
+
+    def __init__(self):
+        self.images = None
+        self.ic_masks = None
+        self.oc_masks = None
+        self.shapes = np.zeros((0, 2), dtype=np.intp)
+        self.ic_paths = []
+        self.oc_paths = []
+        self.indices = None
+        self.tags = None
+        # flat arrays backing the stacked arrays, by name
+        self._storage = {}
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def _buffer(self, name, dtype, shape):
+        """Get an array of the given shape over the reusable storage of name,
+        reallocating the storage only if it is too small or of another type
+        """
+        size = int(np.prod(shape))
+        storage = self._storage.get(name)
+        if storage is None or storage.dtype != dtype or storage.size < size:
+            storage = self._storage[name] = np.empty(size, dtype=dtype)
+        return storage[:size].reshape(shape)
+
+    def fill(self, indices, records, tags=None, fields=ALL_FIELDS):
+        """Stack the given records into the arrays of this batch.
+
+        :param indices: the record indices of the batch
+        :param records: list of RecordData of the batch
+        :param tags: optional list of record tags
+        :param fields: bit mask of the fields to stack, see field_mask; the
+                       arrays and lists of the others are None
+        :return: this object
+        """
+        shapes = np.array([next((a.shape for a in d[:3] if a is not None),
+                                (0, 0))
+                           for d in records], dtype=np.intp).reshape(-1, 2)
+        dtypes = [d.dicom.dtype for d in records if d.dicom is not None]
+        self.allocate(shapes, dtypes, fields)
+        for k, data in enumerate(records):
+            self.put(k, data)
+        self.indices = indices
+        self.tags = tags
+        return self
+
+    def allocate(self, shapes, dtypes, fields=ALL_FIELDS):
+        """Size the arrays for records of the given shapes, to be written
+        with put.
+
+        :param shapes: (B, 2) integer array of (rows, cols) of the records
+        :param dtypes: list of the image data types of the records
+        :param fields: see fill
+        """
+        height, width = shapes.max(axis=0) if len(shapes) else (0, 0)
+        dtype = np.result_type(*dtypes) if dtypes else np.dtype(np.int16)
+        shape = (len(shapes), height, width)
+        for attr, name, stack_dtype in (('images', 'dicom', dtype),
+                                        ('ic_masks', 'ic_mask', np.bool_),
+                                        ('oc_masks', 'oc_mask', np.bool_)):
+            setattr(self, attr, self._buffer(attr, stack_dtype, shape)
+                    if fields & FIELD_BITS[name] else None)
+        self.shapes = shapes
+        self.ic_paths = [None] * len(shapes)\
+            if fields & FIELD_BITS['ic_path'] else None
+        self.oc_paths = [None] * len(shapes)\
+            if fields & FIELD_BITS['oc_path'] else None
+
+    def put(self, k, data):
+        """Write one record into the arrays sized by allocate.
+
+        Different records may be put from different threads at once.
+
+        :param k: position of the record in the batch
+        :param data: RecordData of the record
+        """
+        rows, cols = self.shapes[k]
+        for attr, name in (('images', 'dicom'), ('ic_masks', 'ic_mask'),
+                           ('oc_masks', 'oc_mask')):
+            out = getattr(self, attr)
+            if out is None:
+                continue
+            value = getattr(data, name)
+            if value is None or rows < out.shape[1] or cols < out.shape[2]:
+                out[k] = 0
+            if isinstance(value, PackedMask):
+                value.unpack_into(out[k, :rows, :cols])
+            elif value is not None:
+                out[k, :rows, :cols] = value
+        if self.ic_paths is not None:
+            self.ic_paths[k] = data.ic_path
+        if self.oc_paths is not None:
+            self.oc_paths[k] = data.oc_path
+
+
+class Volume(StackedBatch):
+    """The slices of one patient stacked into contiguous (Z, H, W) arrays.
+
+    The slices are ordered by serial ID or by slice location, see
+    DicomContourParser.volume. Like in a StackedBatch, smaller slices are
+    zero-padded and shapes holds their original (rows, cols).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.patient_id = None
+        self.original_id = None
+        self.serial_ids = np.zeros(0, dtype=np.int32)
+        # slice location from the DICOM header of each slice, NaN if unknown
+        self.slice_locations = np.zeros(0)
+
+
+# header metadata of the DICOM file of each record, see RecordTable.metadata
+METADATA_DTYPE = np.dtype([
+    ('valid', np.bool_),        # False if there is no readable DICOM file
+    ('rows', np.int32),
+    ('cols', np.int32),
+    ('dtype', 'U8'),            # dtype string of the pixel data, e.g. '<i2'
+    ('slope', np.float64),
+    ('intercept', np.float64),
+    ('slice_location', np.float64),
+])
+
+
+# contour path of records without that contour
+_EMPTY_PATH = np.zeros((0, 2))
+_EMPTY_PATH.flags.writeable = False
+
+
+def field_mask(fields):
+    """Get the bit mask of a selection of RecordData fields.
+
+    :param fields: a field name, an iterable of field names, or None for all
+                   fields
+    :return: integer bit mask, see FIELD_BITS
+    """
+    if fields is None:
+        return ALL_FIELDS
+    if isinstance(fields, str):
+        fields = (fields,)
+    mask = 0
+    for name in fields:
+        if name not in FIELD_BITS:
+            raise ValueError('Unknown field {!r}, expected one of {}'.format(
+                name, ', '.join(RecordData._fields)))
+        mask |= FIELD_BITS[name]
+    return mask
+
+
+def _contour_shape(path):
+    """Get the size of the mask of a contour without an image, i.e. its
+    bounding box from the origin.
+
+    :param path: (N, 2) array of x, y coordinates of the contour
+    :return: 2-tuple (height, width)
+    """
+    max_x, max_y = np.maximum(path.max(axis=0), 0) if len(path) else (0, 0)
+    return int(round(float(max_x) + 1)), int(round(float(max_y) + 1))
+
+
+def _contour_to_mask(path, shape):
+    """Rasterize a contour path to the size of the DICOM image.
+
+    :param path: (N, 2) array of x, y coordinates of the contour
+    :param shape: (rows, cols) of the DICOM image, or None to size the mask by
+                  the contour's bounding box
+    :return: Boolean mask
+    """
+    height, width = shape if shape is not None else _contour_shape(path)
+    return parsing.poly_to_mask(path, width, height)
+
+
+def _parse_dicom_and_contour_files(filenames, fields=ALL_FIELDS,
+                                   compact=False):
     """Convert two filenames to valid image data
 
+    Only the work the requested fields need is done: the pixel data is not
+    decoded unless the image is asked for, the masks of a record without its
+    image only read the DICOM header for their size, and contours are not
+    rasterized unless their masks are asked for.
+
     :param filenames: a 3-tuple record of dicom_filename, icontour_filename,
            and ocontour_filename:
            dicom_filename is the path string to the DICOM file
            icontour_filename is the path string to the i-contour file
            ocontour_filename is the path string to the o-contour file
+    :param fields: bit mask of the fields to parse, see field_mask; the other
+                   fields are None
+    :param compact: store the masks as PackedMask objects, with masks of
+                    records without a contour never allocated
     :return: 5-tuple (RecordData) containing the DICOM image data and contour
              mask data
     """
-    dicom_filename, icontour_filename, ocontour_filename = filenames
-    dicom_data, icontour_data, ocontour_data = None, None, None
-    icontour_path, ocontour_path = [], []
-    if dicom_filename:
+    dicom_filename = filenames[0]
+    want = dict((name, bool(fields & bit)) for name, bit in FIELD_BITS.items())
+    values = dict.fromkeys(RecordData._fields)
+    shape = None
+    if dicom_filename and want['dicom']:
         dicom_data = parsing.parse_dicom_file(dicom_filename)
         if dicom_data is not None:
-            dicom_data = dicom_data['pixel_data']
-    if icontour_filename:
-        icontour_path = parsing.parse_contour_file(icontour_filename)
-        if dicom_data is not None:
-            height, width = dicom_data.shape
-        else:
-            max_x, max_y = 0, 0
-            for x, y in icontour_path:
-                max_x = max(max_x, x)
-                max_y = max(max_y, y)
-            height = round(max_x + 1)
-            width = round(max_y + 1)
-        icontour_data = parsing.poly_to_mask(icontour_path, width, height)
-    if ocontour_filename:
-        ocontour_path = parsing.parse_contour_file(ocontour_filename)
-        if dicom_data is not None:
-            height, width = dicom_data.shape
-        else:
-            max_x, max_y = 0, 0
-            for x, y in ocontour_path:
-                max_x = max(max_x, x)
-                max_y = max(max_y, y)
-            height = round(max_x + 1)
-            width = round(max_y + 1)
-        ocontour_data = parsing.poly_to_mask(ocontour_path, width, height)
+            values['dicom'] = dicom_data['pixel_data']
+            shape = values['dicom'].shape
+    elif dicom_filename and (want['ic_mask'] or want['oc_mask']):
+        metadata = parsing.parse_dicom_metadata(dicom_filename)
+        if metadata is not None:
+            shape = (metadata['rows'], metadata['cols'])
+    # without an image, the image is sized like the first contour's mask
+    image_shape = None
+    for prefix, filename in zip(('ic', 'oc'), filenames[1:]):
+        path_name, mask_name = prefix + '_path', prefix + '_mask'
+        if not filename:
+            if want[path_name]:
+                values[path_name] = _EMPTY_PATH
+            continue
+        if not (want[path_name] or want[mask_name] or
+                (want['dicom'] and shape is None and image_shape is None)):
+            continue
+        path = parsing.parse_contour_array(filename)
+        if want[path_name]:
+            values[path_name] = path
+        if want[mask_name]:
+            values[mask_name] = _contour_to_mask(path, shape)
+            if compact:
+                values[mask_name] = PackedMask.pack(values[mask_name])
+        if shape is None and image_shape is None:
+            image_shape = _contour_shape(path)
     # TODO: fix the case in which all of them are None
-    if dicom_data is not None:
-        if icontour_data is None:
-            icontour_data = np.zeros(dicom_data.shape, dtype=np.bool_)
-        if ocontour_data is None:
-            ocontour_data = np.zeros(dicom_data.shape, dtype=np.bool_)
-    else:
-        if icontour_data is not None:
-            dicom_data = np.zeors(icontour_data.shape, dtype=np.int16)
-        elif ocontour_data is not None:
-            dicom_data = np.zeors(ocontour_data.shape, dtype=np.int16)
-    return RecordData(dicom_data, icontour_data, ocontour_data, icontour_path,
-                      ocontour_path)
+    if shape is not None:
+        for mask_name in ('ic_mask', 'oc_mask'):
+            if want[mask_name] and values[mask_name] is None:
+                values[mask_name] = empty_mask(shape) if compact else\
+                    np.zeros(shape, dtype=np.bool_)
+    elif want['dicom'] and image_shape is not None:
+        values['dicom'] = np.zeros(image_shape, dtype=np.int16)
+    return RecordData(**values)
+
+
+def _load_dicom_and_contour_files(filenames, cache=None, fields=ALL_FIELDS,
+                                  compact=False):
+    """Get the image data of a record from the cache, or parse it.
+
+    Only complete records are written to the cache, always with unpacked
+    masks.
+
+    :param filenames: 3-tuple of dicom, i-contour and o-contour filenames
+    :param cache: a SliceCache object, or None to always parse
+    :param fields: bit mask of the fields to parse, see field_mask
+    :param compact: see _parse_dicom_and_contour_files
+    :return: 5-tuple (RecordData) containing the DICOM image data and contour
+             mask data
+    """
+    stats = instrumentation.active
+    if cache is not None:
+        values = cache.get(filenames)
+        if values is not None:
+            if stats is not None:
+                stats.count('slice_cache_hit')
+            data = RecordData(**values)
+            return compact_masks(data) if compact else data
+        if stats is not None:
+            stats.count('slice_cache_miss')
+        if fields == ALL_FIELDS:
+            data = _parse_dicom_and_contour_files(filenames, fields)
+            cache.put(filenames, data)
+            return compact_masks(data) if compact else data
+    return _parse_dicom_and_contour_files(filenames, fields, compact)
 
 
 def _list_valid_files(directory):
     """List valid files in the given directory
 
+    The file type comes from the directory entry itself, so only symbolic
+    links cost an extra stat call.
+
     :param directory: path string to the directory under question
-    :return: iterator of filenames
+    :return: list of filenames
+    """
+    with os.scandir(directory) as it:
+        return [entry.name for entry in it if entry.is_file()]
+
+
+class RecordTable:
+    """A columnar table holding the records of a data set.
+
+    Patient IDs, directories and file names are interned into lists, and
+    every record is one row of small integer columns indexing into them. The
+    loaded data of every record lives in the data column.
     """
-    return (f for f in os.listdir(directory)
-            if opath.exists(opath.join(directory, f)) and
-            opath.isfile(opath.join(directory, f)))
+
+    def __init__(self, cache=None, memory=None, compact=False):
+        """Initialize an empty table.
+
+        :param cache: an optional SliceCache object to load the data through
+        :param memory: an optional MemoryCache object that keeps loaded rows
+                       resident within a byte budget
+        :param compact: keep the masks as PackedMask objects
+        """
+        self.cache = cache
+        self.memory = memory
+        self.compact = compact
+        # pool that aload runs the loads on, None for the event loop's default
+        self.executor = None
+        # (event loop, row index, fields) -> asyncio future of each load
+        # started by aload
+        self._inflight = {}
+        # interned (patient_id, original_id) pairs, directories and names
+        self.patients = []
+        self.dirs = []
+        self.names = []
+        self._index = {}
+        self.patient = np.zeros(0, dtype=np.int32)
+        self.serial_id = np.zeros(0, dtype=np.int32)
+        # dicom, i-contour and o-contour file of each row, -1 if missing
+        self.file_dir = np.zeros((0, 3), dtype=np.int32)
+        self.file_name = np.zeros((0, 3), dtype=np.int32)
+        self.data = np.empty(0, dtype=object)
+        # shared memory slot backing the data of each row, -1 if none
+        self.slot = np.zeros(0, dtype=np.int32)
+        self.slot_ring = None
+        # loading state and pin count of each row, guarded by _cond
+        self.state = np.zeros(0, dtype=np.uint8)
+        self.pins = np.zeros(0, dtype=np.int32)
+        self.clear_pending = np.zeros(0, dtype=np.bool_)
+        # bit mask of the loaded fields of each row, see FIELD_BITS
+        self.fields = np.zeros(0, dtype=np.uint8)
+        self._cond = Condition(RLock())
+        # header metadata and (rows, cols) image shape of each row, read on
+        # demand by metadata and shapes
+        self.meta = None
+        self.shape = None
+        self._chunks = []
+
+    def __len__(self):
+        return len(self.patient)
+
+    def _intern(self, values, value):
+        """Get the index of value in values, appending it if needed
+        """
+        key = (id(values), value)
+        index = self._index.get(key)
+        if index is None:
+            index = self._index[key] = len(values)
+            values.append(value)
+        return index
+
+    def extend(self, patient_id, original_id, rows):
+        """Queue the rows of one patient; call flush to add them.
+
+        :param patient_id: string with the patient's id
+        :param original_id: string with the original id
+        :param rows: iterable of 4-tuples of serial ID, DICOM filename,
+                     i-contour filename, and o-contour filename, with empty
+                     strings for missing files
+        """
+        patient = self._intern(self.patients, (patient_id, original_id))
+        serial_ids, dirs, names = [], [], []
+        for serial_id, *filenames in rows:
+            serial_ids.append(serial_id)
+            for filename in filenames:
+                if filename:
+                    directory, name = opath.split(filename)
+                    dirs.append(self._intern(self.dirs, directory))
+                    names.append(self._intern(self.names, name))
+                else:
+                    dirs.append(-1)
+                    names.append(-1)
+        self._chunks.append((
+            np.full(len(serial_ids), patient, dtype=np.int32),
+            np.array(serial_ids, dtype=np.int32),
+            np.array(dirs, dtype=np.int32).reshape(-1, 3),
+            np.array(names, dtype=np.int32).reshape(-1, 3)))
+
+    def flush(self):
+        """Add the rows queued by extend to the table.
+        """
+        if not self._chunks:
+            return
+        patient, serial_id, file_dir, file_name = zip(*self._chunks)
+        self._chunks = []
+        num_new = sum(len(p) for p in patient)
+        self.patient = np.concatenate((self.patient,) + patient)
+        self.serial_id = np.concatenate((self.serial_id,) + serial_id)
+        self.file_dir = np.concatenate((self.file_dir,) + file_dir)
+        self.file_name = np.concatenate((self.file_name,) + file_name)
+        self.data = np.concatenate((self.data,
+                                    np.empty(num_new, dtype=object)))
+        self.slot = np.concatenate((self.slot,
+                                    np.full(num_new, -1, dtype=np.int32)))
+        self.state = np.concatenate((self.state,
+                                     np.zeros(num_new, dtype=np.uint8)))
+        self.pins = np.concatenate((self.pins,
+                                    np.zeros(num_new, dtype=np.int32)))
+        self.clear_pending = np.concatenate(
+            (self.clear_pending, np.zeros(num_new, dtype=np.bool_)))
+        self.fields = np.concatenate((self.fields,
+                                      np.zeros(num_new, dtype=np.uint8)))
+        self.meta = None
+        self.shape = None
+
+    def filenames(self, index):
+        """Rebuild the 3-tuple of filenames of a row.
+
+        :param index: row index
+        :return: 3-tuple of path strings, empty strings for missing files
+        """
+        return tuple(opath.join(self.dirs[d], self.names[n]) if n >= 0 else ''
+                     for d, n in zip(self.file_dir[index],
+                                     self.file_name[index]))
+
+    def read_metadata(self, index):
+        """Read the header metadata of a row, without decoding pixel data.
+
+        :param index: row index
+        :return: a METADATA_DTYPE scalar
+        """
+        meta = None
+        if self.has_file(index, 0):
+            meta = parsing.parse_dicom_metadata(self.filenames(index)[0])
+        if meta is None:
+            row = (False, 0, 0, '', np.nan, np.nan, np.nan)
+        else:
+            row = (True, meta['rows'], meta['cols'], meta['dtype'].str,
+                   meta['slope'], meta['intercept'], meta['slice_location'])
+        return np.array(row, dtype=METADATA_DTYPE)[()]
+
+    def metadata(self, num_workers=None):
+        """Get the header metadata of all rows.
+
+        The headers are read on a thread pool the first time, without reading
+        or decoding any pixel data.
+
+        :param num_workers: number of threads reading the headers
+        :return: array of METADATA_DTYPE
+        """
+        if self.meta is None:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                rows = list(executor.map(self.read_metadata, range(len(self))))
+            self.meta = np.array(rows, dtype=METADATA_DTYPE)
+        return self.meta
+
+    def shapes(self, num_workers=None):
+        """Get the image shapes of all rows.
+
+        The shapes come from metadata; rows without a readable DICOM file are
+        parsed to get the shape of their masks.
+
+        :param num_workers: see metadata
+        :return: (N, 2) array of (rows, cols)
+        """
+        if self.shape is None:
+            meta = self.metadata(num_workers)
+            shape = np.stack((meta['rows'], meta['cols']), axis=1)
+            for i in np.nonzero(~meta['valid'])[0]:
+                data = self.read(i)
+                if data.dicom is not None:
+                    shape[i] = data.dicom.shape
+            self.shape = shape
+        return self.shape
+
+    def estimated_nbytes(self, num_workers=None):
+        """Estimate the size of the parsed data of all rows from metadata.
+
+        :param num_workers: see metadata
+        :return: array of the bytes of the image and the two masks of each
+                 row, without the contour paths; compact masks are counted
+                 as if they were not empty
+        """
+        meta = self.metadata(num_workers)
+        names, inverse = np.unique(meta['dtype'], return_inverse=True)
+        itemsize = np.array([np.dtype(n).itemsize if n else 2 for n in names],
+                            dtype=np.int64)[inverse.ravel()]
+        shape = self.shapes(num_workers).astype(np.int64)
+        size = shape[:, 0] * shape[:, 1]
+        if self.compact:
+            return size * itemsize + 2 * ((size + 7) // 8)
+        return size * (itemsize + 2)
+
+    def has_file(self, index, kind):
+        """Check if a row has a file of the given kind.
+
+        :param index: row index, or an index array
+        :param kind: 0 for DICOM, 1 for i-contour, 2 for o-contour
+        :return: boolean, or boolean array
+        """
+        return self.file_name[index, kind] >= 0
+
+    def load(self, index, fields=ALL_FIELDS):
+        """Load and parse the data of a row from disk.
+
+        If another thread is loading the row already, wait for that load
+        instead of starting a second one.
+
+        :param index: row index
+        :param fields: bit mask of the fields to load, see field_mask
+        :return: the loaded data
+        """
+        with self._cond:
+            if self.state[index] == LOADING:
+                while self.state[index] == LOADING:
+                    self._cond.wait()
+                if not self.missing(index, fields):
+                    return self.data[index]
+            fields = self.missing(index, fields) or fields
+            self.state[index] = LOADING
+        try:
+            data = self.read(index, fields)
+        except BaseException:
+            self.abandon(index)
+            raise
+        return self.store(index, data, fields=fields)
+
+    def read(self, index, fields=ALL_FIELDS):
+        """Parse the data of a row without storing it in the table.
+
+        :param index: row index
+        :param fields: bit mask of the fields to parse, see field_mask
+        :return: 5-tuple (RecordData)
+        """
+        stats = instrumentation.active
+        if stats is None:
+            return _load_dicom_and_contour_files(
+                self.filenames(index), self.cache, fields, self.compact)
+        start = time.perf_counter()
+        data = _load_dicom_and_contour_files(self.filenames(index),
+                                             self.cache, fields, self.compact)
+        stats.record('load_record', time.perf_counter() - start)
+        return data
+
+    def missing(self, index, fields=ALL_FIELDS):
+        """Get the fields of a row that still need to be read.
+
+        Data backed by a shared memory slot is not merged with, so all of its
+        fields are read again.
+
+        :param index: row index
+        :param fields: bit mask of the fields wanted, see field_mask
+        :return: bit mask of the fields to read, 0 if none
+        """
+        if self.data[index] is None:
+            return fields
+        loaded = int(self.fields[index])
+        if fields & ~loaded and self.slot[index] >= 0:
+            return fields | loaded
+        return fields & ~loaded
+
+    def claim(self, index, fields=ALL_FIELDS):
+        """Mark a row as loading, unless it has the given fields or is being
+        loaded.
+
+        A successful claim must be followed by store or abandon.
+
+        :param index: row index
+        :param fields: bit mask of the fields wanted, see field_mask
+        :return: bit mask of the fields the caller is to load, 0 if none
+        """
+        with self._cond:
+            if self.state[index] == LOADING:
+                return 0
+            fields = self.missing(index, fields)
+            if fields:
+                self.state[index] = LOADING
+            return fields
+
+    def store(self, index, data, slot=-1, fields=ALL_FIELDS):
+        """Store the loaded data of a row and wake up threads waiting for it.
+
+        The fields are merged into the fields loaded before, unless those are
+        backed by a shared memory slot; see missing.
+
+        :param index: row index
+        :param data: 5-tuple (RecordData)
+        :param slot: the shared memory slot backing the data, -1 if none
+        :param fields: bit mask of the fields loaded into data
+        :return: the data of the row
+        """
+        with self._cond:
+            previous = self.data[index]
+            if previous is not None and self.slot[index] < 0:
+                data = previous._replace(**dict(
+                    (name, getattr(data, name))
+                    for name, bit in FIELD_BITS.items() if fields & bit))
+                fields |= int(self.fields[index])
+            elif self.slot[index] >= 0:
+                self.slot_ring.release(int(self.slot[index]))
+            self.data[index] = data
+            self.slot[index] = slot
+            self.fields[index] = fields
+            self.state[index] = LOADED
+            self._cond.notify_all()
+        if slot < 0:
+            self.track(index)
+        return data
+
+    def abandon(self, index):
+        """Give up a claimed load that failed or was cancelled.
+
+        Fields loaded before the claim stay loaded.
+
+        :param index: row index
+        """
+        with self._cond:
+            self.state[index] = LOADED if self.data[index] is not None\
+                else NOT_LOADED
+            self._cond.notify_all()
+
+    def wait(self, index):
+        """Wait until a row is not being loaded.
+
+        :param index: row index
+        :return: the data of the row, None if the load failed
+        """
+        with self._cond:
+            while self.state[index] == LOADING:
+                self._cond.wait()
+            return self.data[index]
+
+    def track(self, index):
+        """Account a freshly loaded row in the memory cache, evicting the
+        least recently used unpinned rows if it is over budget.
+
+        :param index: row index
+        """
+        if self.memory is None:
+            return
+        data = self.data[index]
+        if data is None:
+            return
+        for evicted in self.memory.add(index, data_nbytes(data),
+                                       keep=self.pins.__getitem__):
+            self._drop(evicted)
+
+    def get(self, index, fields=ALL_FIELDS):
+        """Get the data of a row, loading the given fields if they are not
+        resident.
+
+        :param index: row index
+        :param fields: bit mask of the fields wanted, see field_mask; other
+                       fields of the result may be None
+        :return: the data of the row
+        """
+        data = self.data[index]
+        if data is None or self.missing(index, fields):
+            return self.load(index, fields)
+        if self.memory is not None:
+            self.memory.hit(index)
+        return data
+
+    async def aload(self, index, executor=None, fields=ALL_FIELDS):
+        """Get the data of a row without blocking the event loop.
+
+        The row is loaded on a pool unless it is resident. Concurrent calls
+        for the same row and fields wait for the same load.
+
+        :param index: row index
+        :param executor: the pool to load on; defaults to the executor
+                         attribute, or the event loop's default pool
+        :param fields: bit mask of the fields wanted, see field_mask
+        :return: the data of the row
+        """
+        data = self.data[index]
+        if data is not None and not self.missing(index, fields):
+            if self.memory is not None:
+                self.memory.hit(index)
+            return data
+        # futures are bound to the loop they were created on
+        key = (asyncio.get_running_loop(), index, fields)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._aread(index, executor or self.executor, fields))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # one awaiter giving up does not cancel the load of the others
+        return await asyncio.shield(future)
+
+    async def _aread(self, index, executor, fields):
+        """Load a row on a pool and store it; see aload.
+        """
+        loop = asyncio.get_running_loop()
+        if not isinstance(executor, ProcessPoolExecutor):
+            return await loop.run_in_executor(executor, self.get, index,
+                                              fields)
+        claimed = self.claim(index, fields)
+        if not claimed:
+            # resident, or being loaded by another thread
+            return await loop.run_in_executor(None, self.get, index, fields)
+        try:
+            # the table itself does not go to worker processes
+            data = await loop.run_in_executor(
+                executor, _load_dicom_and_contour_files,
+                self.filenames(index), self.cache, claimed, self.compact)
+        except BaseException:
+            self.abandon(index)
+            raise
+        return self.store(index, data, fields=claimed)
+
+    def pin(self, index):
+        """Keep the data of a row from being cleared or evicted.
+
+        Pins are counted; every pin needs an unpin.
+
+        :param index: row index
+        """
+        with self._cond:
+            self.pins[index] += 1
+
+    def unpin(self, index):
+        """Release a pin, and clear the row if that was asked for while it
+        was pinned. The memory cache evicts rows it kept over budget only
+        because they were pinned.
+
+        :param index: row index
+        """
+        with self._cond:
+            self.pins[index] -= 1
+            unpinned = self.pins[index] == 0
+            pending = unpinned and self.clear_pending[index]
+        if pending:
+            self.clear(index)
+        elif unpinned and self.memory is not None:
+            for evicted in self.memory.evict(keep=self.pins.__getitem__):
+                self._drop(evicted)
+
+    def _drop(self, index):
+        """Drop the data of a row already removed from the memory cache
+        """
+        with self._cond:
+            if self.slot[index] >= 0:
+                self.slot_ring.release(int(self.slot[index]))
+                self.slot[index] = -1
+            # a row loading more fields is settled by store or abandon
+            if self.state[index] == LOADED:
+                self.state[index] = EVICTED
+            self.data[index] = None
+            self.fields[index] = 0
+
+    def drop_slots(self):
+        """Drop the data of every row backed by a shared memory slot, even if
+        the row is pinned, without giving the slots back to the ring; meant
+        for closing the ring.
+        """
+        with self._cond:
+            for index in np.nonzero(self.slot >= 0)[0]:
+                self.slot[index] = -1
+                self.clear_pending[index] = False
+                self.data[index] = None
+                self.fields[index] = 0
+                if self.state[index] == LOADED:
+                    self.state[index] = EVICTED
+            self._cond.notify_all()
+
+    def clear(self, index):
+        """Drop the data of a row, or only mark it to be dropped once the row
+        is unpinned.
+
+        A pinned row backed by a shared memory slot keeps its slot until then,
+        since batches already yielded may hold views over it.
+
+        :param index: row index
+        """
+        with self._cond:
+            if self.pins[index] > 0:
+                self.clear_pending[index] = True
+                return
+            self.clear_pending[index] = False
+            self._drop(index)
+        if self.memory is not None:
+            self.memory.discard(index)
 
 
 class Record:
     """A class that holds the record of one patient.
+
+    A Record is a light view over one row of a RecordTable.
     """
 
-    def __init__(self, patient_id, original_id, serial_id, filenames):
+    __slots__ = ('table', 'index')
+
+    def __init__(self, patient_id, original_id, serial_id, filenames,
+                 cache=None):
         """Initialize with patient ID, original ID, and image-label data.
 
+        This creates a table of its own; records of a data set are created
+        with Record.view instead.
+
         :param patient_id: string with the patient's id
         :param original_id: string with the original id
         :param serial_id: integer index within one patient's record
-        :param filenames: a 2-tuple that contains dicom filename and contour
-                          filename
+        :param filenames: a 3-tuple that contains dicom filename, i-contour
+                          filename, and o-contour filename
+        :param cache: an optional SliceCache object to load the data through
+        """
+        self.table = RecordTable(cache)
+        self.table.extend(patient_id, original_id,
+                          [(serial_id,) + tuple(filenames)])
+        self.table.flush()
+        self.index = 0
+
+    @classmethod
+    def view(cls, table, index):
+        """Get the record of one row of a table.
+
+        :param table: a RecordTable object
+        :param index: row index
+        :return: a Record object
+        """
+        record = cls.__new__(cls)
+        record.table = table
+        record.index = index
+        return record
+
+    @property
+    def patient_id(self):
+        return self.table.patients[self.table.patient[self.index]][0]
+
+    @property
+    def original_id(self):
+        return self.table.patients[self.table.patient[self.index]][1]
+
+    @property
+    def serial_id(self):
+        return int(self.table.serial_id[self.index])
+
+    @property
+    def filenames(self):
+        return self.table.filenames(self.index)
+
+    @property
+    def metadata(self):
+        """The DICOM header metadata of the record, see METADATA_DTYPE
         """
-        self.patient_id = patient_id
-        self.original_id = original_id
-        self.serial_id = serial_id
-        self.filenames = filenames
-        self._data = None
+        if self.table.meta is not None:
+            return self.table.meta[self.index]
+        return self.table.read_metadata(self.index)
+
+    @property
+    def _data(self):
+        return self.table.data[self.index]
 
     def clear_data(self):
         """Free up space occupied by the data field.
         """
-        self._data = None
+        self.table.clear(self.index)
 
     def load_data(self):
         """Load and parse data from disk.
         """
-        self._data = _parse_dicom_and_contour_files(self.filenames)
+        self.table.load(self.index)
+
+    async def aload(self, executor=None):
+        """Get the data without blocking the event loop; see
+        RecordTable.aload.
+
+        :param executor: optional pool to load on
+        :return: 5-tuple (RecordData)
+        """
+        return await self.table.aload(self.index, executor)
+
+    @property
+    def state(self):
+        """The loading state of the record: one of NOT_LOADED, LOADING,
+        LOADED and EVICTED
+        """
+        return int(self.table.state[self.index])
+
+    def pin(self):
+        """Keep the data from being cleared by iterators or evicted by the
+        memory cache until unpin is called.
+        """
+        self.table.pin(self.index)
+
+    def unpin(self):
+        """Release a pin taken with pin.
+        """
+        self.table.unpin(self.index)
+
+    @contextmanager
+    def pinned(self):
+        """Pin the record for the duration of a with block.
+
+        usage:
+        with record.pinned():
+            # record.data stays resident here
+        """
+        self.pin()
+        try:
+            yield self
+        finally:
+            self.unpin()
 
     def has_dicom(self):
         """Check if there is DICOM image
         """
-        return self.filenames[0] != ''
+        return bool(self.table.has_file(self.index, 0))
 
     def has_icontour(self):
         """Check if there is i-contour image
         """
-        return self.filenames[1] != ''
+        return bool(self.table.has_file(self.index, 1))
 
     def has_ocontour(self):
         """Check if there is o-contour image
         """
-        return self.filenames[2] != ''
+        return bool(self.table.has_file(self.index, 2))
 
     @property
     def data(self):
         """A property that when called will load and parse DICOM image file and
         contour file lazily, unless they are already loaded.
         """
-        if self._data is None:
-            self.load_data()
-        return self._data
+        return self.table.get(self.index)
+
+    def get_fields(self, fields):
+        """Load only the given fields of the data, unless they are already
+        loaded.
+
+        :param fields: a RecordData field name or an iterable of them
+        :return: 5-tuple (RecordData) in which the fields not asked for may
+                 be None
+        """
+        return self.table.get(self.index, field_mask(fields))
+
+    @property
+    def dicom(self):
+        """The DICOM image, loaded without the masks on first access
+        """
+        return self.get_fields('dicom').dicom
+
+    @property
+    def ic_mask(self):
+        """The i-contour mask, loaded without the image on first access, and
+        unpacked if it is stored compactly
+        """
+        mask = self.get_fields('ic_mask').ic_mask
+        return mask.unpack() if isinstance(mask, PackedMask) else mask
+
+    @property
+    def oc_mask(self):
+        """The o-contour mask, loaded without the image on first access, and
+        unpacked if it is stored compactly
+        """
+        mask = self.get_fields('oc_mask').oc_mask
+        return mask.unpack() if isinstance(mask, PackedMask) else mask
+
+    @property
+    def ic_path(self):
+        """The i-contour path, loaded without the image or masks on first
+        access
+        """
+        return self.get_fields('ic_path').ic_path
+
+    @property
+    def oc_path(self):
+        """The o-contour path, loaded without the image or masks on first
+        access
+        """
+        return self.get_fields('oc_path').oc_path
+
+
+class RecordList:
+    """A read-only sequence of Record views over all rows of a RecordTable.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Record.view(self.table, i)
+                    for i in range(*index.indices(len(self.table)))]
+        if index < 0:
+            index += len(self.table)
+        if not 0 <= index < len(self.table):
+            raise IndexError('record index out of range')
+        return Record.view(self.table, index)
+
+    def __iter__(self):
+        return (Record.view(self.table, i) for i in range(len(self.table)))
+
+
+def epoch_random_state(seed, epoch):
+    """Get the random state that draws the order of one epoch.
+
+    :param seed: integer seed, or None for the global NumPy random state
+    :param epoch: epoch number
+    :return: a np.random.RandomState object, or np.random
+    """
+    if seed is None:
+        return np.random
+    return np.random.RandomState([seed, epoch])
+
+
+def check_shard_seed(seed, num_shards):
+    """Check that shards draw their epochs from a shared seed.
+
+    Each shard draws the order of the whole dataset on its own, so shards
+    drawing from different seeds overlap.
+
+    :param seed: integer seed, or None
+    :param num_shards: number of shards
+    """
+    if num_shards > 1 and seed is None:
+        raise ValueError('Sharded iteration needs a seed shared by all '
+                         'shards')
+
+
+class EpochIterator:
+    """A seeded iterator over successive epochs that can be checkpointed.
+
+    Each pass of a for loop runs the rest of the current epoch. The order of
+    an epoch only depends on the seed and the epoch number, so a restored
+    state continues at the same batch of the same order without loading any
+    of the batches before it.
+    """
+
+    def __init__(self, parser, make_batches, batch_size, seed=None,
+                 tag_records=False, stacked=False, fields=None):
+        """Initialize at the start of epoch 0.
+
+        :param parser: the DicomContourParser to load the batches with
+        :param make_batches: callable drawing the batches of one epoch from
+                             the random state given as the rng keyword
+        :param batch_size: number of records in a batch
+        :param seed: integer seed, a random one if None
+        :param tag_records: see DicomContourParser.random_shuffled_iterator
+        :param stacked: see DicomContourParser.random_shuffled_iterator
+        :param fields: see DicomContourParser.random_shuffled_iterator
+        """
+        self.parser = parser
+        self.make_batches = make_batches
+        self.batch_size = batch_size
+        self.seed = int(np.random.randint(2 ** 31)) if seed is None else seed
+        self.tag_records = tag_records
+        self.stacked = stacked
+        self.fields = fields
+        self.epoch = 0
+        # number of batches of the current epoch already yielded
+        self.batch = 0
+
+    def batches(self, epoch=None):
+        """Get the batches of an epoch.
+
+        :param epoch: epoch number, the current one if None
+        :return: list of index arrays
+        """
+        epoch = self.epoch if epoch is None else epoch
+        return self.make_batches(rng=epoch_random_state(self.seed, epoch))
+
+    def __len__(self):
+        return len(self.batches())
+
+    def __iter__(self):
+        batches = self.batches()[self.batch:]
+        for batch in self.parser._iterate_batches(
+                batches, self.batch_size, self.tag_records, self.stacked,
+                self.fields):
+            self.batch += 1
+            yield batch
+        self.epoch += 1
+        self.batch = 0
+
+    def get_state(self):
+        """Get the position of the iterator.
+
+        :return: dictionary of seed, epoch, batch, and batch_size
+        """
+        return {'seed': self.seed, 'epoch': self.epoch, 'batch': self.batch,
+                'batch_size': self.batch_size}
+
+    def set_state(self, state):
+        """Move the iterator to a position returned by get_state.
+
+        :param state: dictionary returned by get_state
+        """
+        if state['batch_size'] != self.batch_size:
+            raise ValueError('State of batch size {} does not fit an iterator '
+                             'of batch size {}'.format(state['batch_size'],
+                                                       self.batch_size))
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.batch = state['batch']
 
 
 class DicomContourParser:
@@ -164,21 +1164,79 @@ class DicomContourParser:
     ICONTOUR_PATTERN = re.compile(r'IM-\d{4}-(\d{4})-icontour.*.txt')
     OCONTOUR_PATTERN = re.compile(r'IM-\d{4}-(\d{4})-ocontour.*.txt')
     DICOM_PATTERN = re.compile(r'(\d+).dcm')
+    LOADERS = ('sync', 'thread', 'process')
+    SAMPLERS = ('shuffled', 'shape_bucketed', 'balanced')
+    BALANCES = ('records', 'patient', 'bytes')
+    ORDERS = ('serial', 'position')
 
-    def __init__(self, path_to_data, async_load=False):
+    def __init__(self, path_to_data, async_load=False, loader=None,
+                 num_workers=None, shared_memory=False,
+                 slot_bytes=shared_slots.DEFAULT_SLOT_BYTES, cache_dir=None,
+                 scan_workers=None, index_file=None, max_cache_bytes=None,
+                 prefetch_depth=1, compact_masks=False):
         """Initialize using the path to the data folder.
 
         :param path_to_data: a string containing the path to the data folder
+        :param async_load: load the next batches in background threads
+                           while the current one is consumed; same as
+                           loader='thread'
+        :param loader: one of 'sync', 'thread' and 'process'; takes precedence
+                       over async_load when given. 'thread' and 'process'
+                       load the records of the next batches on a pool of
+                       worker threads or processes in the background
+        :param num_workers: number of worker threads or processes of the
+                            loader; defaults to the defaults of
+                            ThreadPoolExecutor and ProcessPoolExecutor
+        :param shared_memory: have the 'process' loader's workers write the
+                              arrays into shared memory slots instead of
+                              pickling them back; arrays yielded by the
+                              iterator are then only valid until the next
+                              batch is requested and must be copied to be
+                              kept; cannot be combined with max_cache_bytes
+        :param slot_bytes: size of each shared memory slot; records that do
+                           not fit fall back to pickling
+        :param cache_dir: optional path string to a directory where parsed
+                          records are cached across epochs and runs; see
+                          SliceCache
+        :param scan_workers: number of threads scanning the patient folders
+                             concurrently; defaults to ThreadPoolExecutor's
+                             default, 1 scans them one after another
+        :param index_file: optional path string to a file where the scan
+                           results are kept across runs, so that only the
+                           patient folders that changed are scanned again;
+                           defaults to scan_index.json in cache_dir when
+                           that is given; see ScanIndex
+        :param max_cache_bytes: optional byte budget of loaded records kept
+                                in memory; when given, records stay loaded
+                                after their batch and the least recently
+                                used ones are evicted once the budget is
+                                exceeded, instead of clearing every batch
+                                after it was consumed; see MemoryCache
+        :param prefetch_depth: number of batches the 'thread' and 'process'
+                               loaders load ahead of the one being consumed
+        :param compact_masks: keep the masks of loaded records bit-packed as
+                              PackedMask objects, with all empty masks of a
+                              shape sharing one object; they are unpacked by
+                              np.asarray, by the Record mask properties, and
+                              straight into the arrays of stacked batches
         :return: a DicomContourParser object
 
         """
-        self.async_load = async_load
-        self.loader_thread = None
+        self._setup_loader(async_load, loader, num_workers, shared_memory,
+                           slot_bytes, max_cache_bytes, prefetch_depth)
+        self.cache = SliceCache(cache_dir) if cache_dir is not None else None
         self.link_file = opath.join(path_to_data, 'link.csv')
         self.dicom_dir = opath.join(path_to_data, 'dicoms')
         self.contour_dir = opath.join(path_to_data, 'contourfiles')
         self.id_list = []
-        self.record_list = []
+        self.scan_workers = scan_workers
+        self.scan_report = None
+        if index_file is None and cache_dir is not None:
+            index_file = opath.join(cache_dir, 'scan_index.json')
+        self.scan_index = ScanIndex(index_file, path_to_data)\
+            if index_file is not None else None
+        self.table = RecordTable(self.cache, self.memory_cache, compact_masks)
+        self.record_list = RecordList(self.table)
         if not opath.exists(path_to_data) or\
            not opath.isdir(path_to_data) or\
            not opath.exists(self.link_file) or\
@@ -197,6 +1255,35 @@ class DicomContourParser:
                 self.id_list.append((pid, oid))
         self._parse()
 
+    def _setup_loader(self, async_load, loader, num_workers,
+                      shared_memory=False,
+                      slot_bytes=shared_slots.DEFAULT_SLOT_BYTES,
+                      max_cache_bytes=None, prefetch_depth=1):
+        """Validate and store the loader and memory settings; see __init__.
+        """
+        if loader is None:
+            loader = 'thread' if async_load else 'sync'
+        if loader not in self.LOADERS:
+            raise ValueError('Unknown loader {!r}, expected one of {}'
+                             .format(loader, ', '.join(self.LOADERS)))
+        if prefetch_depth < 0:
+            raise ValueError('prefetch_depth must not be negative')
+        if shared_memory and loader == 'process' and\
+           max_cache_bytes is not None:
+            # records in shared memory slots are cleared after their batch
+            raise ValueError('max_cache_bytes cannot be used with '
+                             'shared_memory')
+        self.loader = loader
+        self.async_load = loader != 'sync'
+        self.num_workers = num_workers
+        self.executor = None
+        self.shared_memory = shared_memory and loader == 'process'
+        self.slot_bytes = slot_bytes
+        self.slot_ring = None
+        self.prefetch_depth = prefetch_depth
+        self.memory_cache = MemoryCache(max_cache_bytes)\
+            if max_cache_bytes is not None else None
+
     def _get_valid_sids(self, dicom_dir, icontour_dir, ocontour_dir):
         """Scan the DICOM and contour directories to find the union of serial
         IDs.
@@ -244,86 +1331,778 @@ class DicomContourParser:
                         ocontour_filename))
         return res
 
+    def _scan_patient(self, ids):
+        """Scan the folders of one patient, or take them from the scan index.
+
+        :param ids: 2-tuple of patient ID and original ID
+        :return: 2-tuple of the list of rows as returned by _get_valid_sids,
+                 or None if the dicom folder or a contour folder is missing,
+                 and whether the folders were actually scanned
+        """
+        pid, oid = ids
+        dicom_dir = opath.join(self.dicom_dir, pid)
+        icontour_dir = opath.join(opath.join(self.contour_dir, oid),
+                                  'i-contours')
+        ocontour_dir = opath.join(opath.join(self.contour_dir, oid),
+                                  'o-contours')
+        directories = (dicom_dir, icontour_dir, ocontour_dir)
+        mtimes = None
+        if self.scan_index is not None:
+            # taken before the scan, so that files added during the scan make
+            # the entry stale
+            mtimes = folder_mtimes(directories)
+            if mtimes is None:
+                return None, False
+            rows = self.scan_index.lookup(ids, directories, mtimes)
+            if rows is not None:
+                return rows, False
+        try:
+            with instrumentation.timed('scan_patient'):
+                rows = self._get_valid_sids(*directories)
+        except FileNotFoundError:
+            return None, True
+        if mtimes is not None:
+            self.scan_index.store(ids, mtimes, rows)
+        return rows, True
+
     def _parse(self):
         """Parse the data folder to produce data records.
 
-        :return: a list of data records (typed Record) organized by images
+        The patients are scanned concurrently on a thread pool, and their rows
+        are added in link.csv order. With a scan index, patients whose folders
+        did not change are taken from the index instead. A summary of the scan
+        is kept in scan_report.
         """
-        self.record_list = []
-        for pid, oid in self.id_list:
-            dicom_dir = opath.join(self.dicom_dir, pid)
-            icontour_dir = opath.join(opath.join(self.contour_dir, oid),
-                                      'i-contours')
-            ocontour_dir = opath.join(opath.join(self.contour_dir, oid),
-                                      'o-contours')
+        start = time.perf_counter()
+        if self.scan_workers == 1:
+            results = list(map(self._scan_patient, self.id_list))
+        else:
+            with ThreadPoolExecutor(max_workers=self.scan_workers) as executor:
+                results = list(executor.map(self._scan_patient, self.id_list))
+        num_skipped, num_scanned = 0, 0
+        for (pid, oid), (sids, scanned) in zip(self.id_list, results):
+            num_scanned += scanned
             # skip any id item whose dicom folder or contour folder is missing
-            if not opath.exists(dicom_dir) or not opath.exists(icontour_dir)\
-               or not opath.exists(ocontour_dir):
+            if sids is None:
+                num_skipped += 1
                 continue
-            sids = self._get_valid_sids(dicom_dir, icontour_dir, ocontour_dir)
-            self.record_list.extend((Record(pid, oid, item[0], item[1:])
-                                     for item in sids))
+            self.table.extend(pid, oid, sids)
+        self.table.flush()
+        if self.scan_index is not None:
+            self.scan_index.save(self.id_list)
+        self.scan_report = ScanReport(len(self.id_list), num_skipped,
+                                      num_scanned, len(self.table),
+                                      time.perf_counter() - start)
+        stats = instrumentation.active
+        if stats is not None:
+            stats.record('scan', self.scan_report.seconds)
+
+    def _submit_batch_data(self, indices, fields=ALL_FIELDS):
+        """Issue data loading on the records at the given indices, one work
+        item per record.
 
-    def _prepare_batch_data(self, low, high):
-        """Issue data loading on the records in [low, high)
+        Records still resident are skipped, and records being loaded by
+        someone else are waited for instead of loaded twice. Each work item
+        stores its result in the table as soon as it is done. The 'sync'
+        loader loads the records right away. Every record is pinned until
+        _invalidate_batch_data, so that the memory cache does not evict it
+        before its batch is used.
 
-        :param low: inclusive lower bound of indices
-        :param high: exclusive higher bound of indices
+        :param indices: sequence of indices into record_list
+        :param fields: bit mask of the fields to load, see field_mask
+        :return: list of (index, slot, future) work items, slot being the
+                 shared memory slot written by the work item or None, and
+                 future being None for records loaded elsewhere
         """
-        low = max(low, 0)
-        high = min(high, len(self.record_list))
-        for i in range(low, high):
-            self.record_list[i].load_data()
+        table = self.table
+        items = []
+        # a record drawn twice into one batch is loaded once
+        for i in dict.fromkeys(indices):
+            table.pin(i)
+            if table.data[i] is not None and not table.missing(i, fields):
+                if table.memory is not None:
+                    table.memory.hit(i)
+                continue
+            claimed = table.claim(i, fields)
+            if not claimed:
+                items.append((i, None, None))
+                continue
+            slot = None
+            if self.loader == 'process':
+                load = partial(_load_dicom_and_contour_files, cache=self.cache,
+                               fields=claimed, compact=table.compact)
+                if self.slot_ring is not None:
+                    slot = self.slot_ring.acquire()
+                    future = self._get_executor().submit(
+                        shared_slots.write_to_slot, load, table.filenames(i),
+                        self.slot_ring.names[slot])
+                else:
+                    future = self._get_executor().submit(
+                        load, table.filenames(i))
+            elif self.loader == 'thread':
+                future = self._get_executor().submit(table.read, i, claimed)
+            else:
+                future = Future()
+            future.add_done_callback(
+                partial(self._finish_item, i, slot, claimed))
+            if self.loader == 'sync':
+                try:
+                    future.set_result(table.read(i, claimed))
+                except Exception as e:
+                    future.set_exception(e)
+            items.append((i, slot, future))
+        return items
 
-    def _async_prepare_batch_data(self, low, high):
-        """Issue data loading on the records in [low, high) in a separate
-        thread.
+    def _finish_item(self, index, slot, fields, future):
+        """Store the result of a finished work item in the table, or give up
+        its claim if it failed or was cancelled.
 
-        :param low: inclusive lower bound of indices
-        :param high: exclusive higher bound of indices
+        :param index: row index of the work item
+        :param slot: the shared memory slot of the work item, or None
+        :param fields: bit mask of the fields loaded by the work item
+        :param future: the finished future of the work item
         """
-        if self.loader_thread is not None:
-            self.loader_thread.join()
-        self.loader_thread = Thread(target=self._prepare_batch_data,
-                                    args=(low, high))
-        self.loader_thread.start()
+        table = self.table
+        if future.cancelled() or future.exception() is not None:
+            if slot is not None:
+                self.slot_ring.release(slot)
+            table.abandon(index)
+            return
+        result = future.result()
+        if slot is not None and not isinstance(result, RecordData):
+            table.store(index, RecordData(
+                *self.slot_ring.read_slot(slot, result)), slot, fields)
+            return
+        if slot is not None:
+            # did not fit into the slot and came back pickled
+            self.slot_ring.release(slot)
+        table.store(index, result, fields=fields)
 
-    def _invalidate_batch_data(self, low, high):
-        """Issue data discarding on the records in [low, high)
+    def _collect_batch_data(self, items):
+        """Wait for work items until their results are stored in the table.
 
-        :param low: inclusive lower bound of indices
-        :param high: exclusive higher bound of indices
+        :param items: list of work items returned by _submit_batch_data
         """
-        low = max(low, 0)
-        high = min(high, len(self.record_list))
-        for i in range(low, high):
-            self.record_list[i].clear_data()
+        table = self.table
+        for i, _, future in items:
+            if future is not None:
+                # raises the error of a failed load
+                future.result()
+            table.wait(i)
 
-    def random_shuffled_iterator(self, batch_size=1, tag_records=False):
-        """Get an iterator that randomly iterate through the dataset
+    def _cancel_batch_data(self, items):
+        """Cancel work items that will not be collected, and wait until no
+        worker writes into their shared memory slots anymore.
+
+        :param items: list of work items returned by _submit_batch_data
         """
-        if tag_records:
-            map_func = lambda r: ('{}:{}:{:06d}'.format(
-                r.patient_id, r.original_id, r.serial_id), r._data)
+        futures = [future for _, _, future in items if future is not None]
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        for i, _, future in items:
+            if future is not None:
+                self.table.wait(i)
+
+    def _prepare_batch_data(self, indices, fields=ALL_FIELDS):
+        """Load the data of the records at the given indices
+
+        :param indices: sequence of indices into record_list
+        :param fields: bit mask of the fields to load, see field_mask
+        """
+        items = self._submit_batch_data(indices, fields)
+        try:
+            self._collect_batch_data(items)
+        except BaseException:
+            self._cancel_batch_data(items)
+            raise
+
+    def _get_executor(self):
+        """Get the pool of the 'thread' or 'process' loader, starting it if
+        needed. The 'sync' loader gets a thread pool for the asynchronous
+        API.
+
+        :return: a ThreadPoolExecutor or ProcessPoolExecutor object
+        """
+        if self.executor is None:
+            if self.loader == 'process':
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.num_workers)
+            else:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.num_workers)
+            # used by Record.aload as well
+            self.table.executor = self.executor
+        return self.executor
+
+    def _ensure_slot_ring(self, num_slots):
+        """Create the shared memory ring if needed.
+
+        Iterations running at the same time share the ring, which grows when
+        they hold more slots than it has; slots held by other iterations are
+        left alone.
+
+        :param num_slots: number of slots needed by one pass of the iterator
+        """
+        if self.slot_ring is None:
+            self.slot_ring = shared_slots.SlotRing(num_slots, self.slot_bytes)
+            self.table.slot_ring = self.slot_ring
+
+    def _release_slots(self):
+        """Drop every record still backed by a shared memory slot, pinned or
+        not, before the ring is closed.
+        """
+        self.table.drop_slots()
+
+    def close(self):
+        """Shut down the worker threads or processes.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.table.executor = None
+        if self.slot_ring is not None:
+            self._release_slots()
+            self.slot_ring.close()
+            self.slot_ring = None
+            self.table.slot_ring = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _invalidate_batch_data(self, indices):
+        """Issue data discarding on the records at the given indices, and
+        release the pins taken by _submit_batch_data
+
+        With a memory cache, only records backed by shared memory slots are
+        discarded; the others stay until the cache evicts them. Records
+        pinned elsewhere are discarded once unpinned.
+
+        :param indices: sequence of indices into record_list
+        """
+        table = self.table
+        for i in dict.fromkeys(indices):
+            if table.slot[i] >= 0 or table.memory is None:
+                table.clear(i)
+            table.unpin(i)
+
+    def _record_tag(self, index):
+        """Get the patient_id:original_id:serial_id tag of a record
+        """
+        table = self.table
+        patient_id, original_id = table.patients[table.patient[index]]
+        return '{}:{}:{:06d}'.format(patient_id, original_id,
+                                     table.serial_id[index])
+
+    def _batch_mapper(self, tag_records=False, stacked=False,
+                      fields=ALL_FIELDS):
+        """Get the function that builds what is yielded for a loaded batch.
+
+        :param tag_records: yield (tag, data) pairs instead of data
+        :param stacked: yield one reused StackedBatch object instead of lists
+        :param fields: bit mask of the fields to yield, see field_mask
+        :return: a callable taking an index array
+        """
+        table = self.table
+
+        def get_data(i):
+            # a record evicted or cleared elsewhere between its preparation
+            # and its batch is loaded again
+            data = table.data[i]
+            if data is None or table.fields[i] & fields != fields:
+                data = table.get(i, fields)
+            return data
+        if stacked:
+            stacked_batch = StackedBatch()
+
+            def map_batch(batch):
+                tags = [self._record_tag(i) for i in batch]\
+                    if tag_records else None
+                return stacked_batch.fill(batch, list(map(get_data, batch)),
+                                          tags, fields)
         else:
-            map_func = lambda r: r._data
-        random.shuffle(self.record_list)
-        num_records = len(self.record_list)
-        prepared_batch = None
-        for low in range(0, len(self.record_list), batch_size):
-            high = min(low + batch_size, num_records)
-            if self.async_load:
-                self._async_prepare_batch_data(low, high)
+            if tag_records:
+                map_func = lambda i: (self._record_tag(i), get_data(i))
             else:
-                self._prepare_batch_data(low, high)
-            if prepared_batch is not None:
-                l, h = prepared_batch
-                yield list(map(map_func, self.record_list[l:h]))
-                self._invalidate_batch_data(l, h)
-            prepared_batch = (low, high)
-        if self.async_load and self.loader_thread is not None:
-            self.loader_thread.join()
-        if prepared_batch is not None:
-            l, h = prepared_batch
-            yield list(map(map_func, self.record_list[l:h]))
-            self._invalidate_batch_data(l, h)
+                map_func = get_data
+            map_batch = lambda batch: list(map(map_func, batch))
+        return map_batch
+
+    def _iterate_batches(self, batches, batch_size, tag_records=False,
+                         stacked=False, fields=None):
+        """Load and yield the given batches through the prefetch pipeline.
+
+        With the 'thread' and 'process' loaders, the records of up to
+        prefetch_depth batches after the one being consumed are loaded in the
+        background, and a batch is yielded as soon as all of its records are
+        ready.
+
+        :param batches: iterable of index arrays into record_list
+        :param batch_size: the largest number of records in a batch
+        :param tag_records: yield (tag, data) pairs instead of data
+        :param stacked: yield one reused StackedBatch object instead of lists
+        :param fields: the RecordData fields to load, None for all of them;
+                       see field_mask
+        :return: iterator of lists of RecordData, or of StackedBatch
+        """
+        fields = field_mask(fields)
+        map_batch = self._batch_mapper(tag_records, stacked, fields)
+        depth = self.prefetch_depth if self.async_load else 0
+        if self.shared_memory:
+            # the batch being consumed plus the ones being prefetched
+            self._ensure_slot_ring((depth + 1) * batch_size)
+        pending = deque()
+        batches = iter(batches)
+        try:
+            while True:
+                # the 'sync' loader loads while submitting, so the stall is
+                # measured from the refill on
+                stats = instrumentation.active
+                start = time.perf_counter()
+                while len(pending) <= depth:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    pending.append(
+                        (batch, self._submit_batch_data(batch, fields)))
+                if not pending:
+                    break
+                batch, items = pending[0]
+                self._collect_batch_data(items)
+                if stats is not None:
+                    stats.record('stall', time.perf_counter() - start)
+                pending.popleft()
+                try:
+                    yield map_batch(batch)
+                finally:
+                    # also when the iterator is closed, to free its slots
+                    self._invalidate_batch_data(batch)
+        finally:
+            for batch, items in pending:
+                self._cancel_batch_data(items)
+                self._invalidate_batch_data(batch)
+
+    async def _aiterate_batches(self, batches, tag_records=False,
+                                stacked=False, fields=None):
+        """Load and yield the given batches without blocking the event loop.
+
+        Records are loaded with RecordTable.aload on the loader's pool, so a
+        record also requested elsewhere is loaded once. Up to prefetch_depth
+        batches after the one being consumed are in flight; no more are
+        started until the consumer asks for the next batch.
+
+        :param batches: iterable of index arrays into record_list
+        :param tag_records: see _iterate_batches
+        :param stacked: see _iterate_batches
+        :param fields: see _iterate_batches
+        :return: asynchronous iterator of batches
+        """
+        fields = field_mask(fields)
+        map_batch = self._batch_mapper(tag_records, stacked, fields)
+        executor = self._get_executor()
+        pending = deque()
+        batches = iter(batches)
+        try:
+            while True:
+                while len(pending) <= self.prefetch_depth:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    # pinned like the records of _submit_batch_data
+                    for i in dict.fromkeys(batch):
+                        self.table.pin(i)
+                    pending.append((batch, [
+                        asyncio.ensure_future(
+                            self.table.aload(i, executor, fields))
+                        for i in dict.fromkeys(batch)]))
+                if not pending:
+                    break
+                batch, tasks = pending[0]
+                stats = instrumentation.active
+                start = time.perf_counter()
+                await asyncio.gather(*tasks)
+                if stats is not None:
+                    stats.record('stall', time.perf_counter() - start)
+                pending.popleft()
+                try:
+                    yield map_batch(batch)
+                finally:
+                    self._invalidate_batch_data(batch)
+        finally:
+            for batch, tasks in pending:
+                for task in tasks:
+                    task.cancel()
+                self._invalidate_batch_data(batch)
+
+    def _draw_batches(self, sampler, batch_size, rng=np.random,
+                      records=None, **options):
+        """Draw the batches of one epoch.
+
+        :param sampler: one of SAMPLERS
+        :param batch_size: number of records in a batch
+        :param rng: see samplers.shuffled_batches
+        :param records: optional index array of the records to draw from,
+                        all records if None
+        :param options: extra arguments of the sampler; positive,
+                        positive_fraction and num_batches for 'balanced'
+        :return: list of index arrays
+        """
+        if records is None:
+            records = np.arange(len(self.table))
+        if sampler == 'shuffled':
+            return samplers.shuffled_batches(records, batch_size, rng)
+        if sampler == 'shape_bucketed':
+            shapes = self.table.shapes(self.scan_workers)[records]
+            return [records[batch] for batch in
+                    samplers.shape_bucketed_batches(shapes, batch_size, rng)]
+        options = dict(options)
+        positive_ids, negative_ids = self.positive_indices(
+            options.pop('positive', 'icontour'))
+        return samplers.balanced_batches(
+            np.intersect1d(positive_ids, records),
+            np.intersect1d(negative_ids, records), batch_size, rng=rng,
+            **options)
+
+    def _sampler(self, sampler, batch_size, num_shards=1, shard_index=0,
+                 balance='records', **options):
+        """Get the function that draws the batches of one epoch.
+
+        :param sampler: one of SAMPLERS
+        :param batch_size: number of records in a batch
+        :param num_shards: number of shards the records are split into
+        :param shard_index: index of the shard to draw the batches of
+        :param balance: one of BALANCES, see random_shuffled_iterator
+        :param options: see _draw_batches
+        :return: a callable taking a random state as the rng keyword and
+                 returning a list of index arrays
+        """
+        if sampler not in self.SAMPLERS:
+            raise ValueError('Unknown sampler {!r}, expected one of {}'
+                             .format(sampler, ', '.join(self.SAMPLERS)))
+        if balance not in self.BALANCES:
+            raise ValueError('Unknown balance {!r}, expected one of {}'
+                             .format(balance, ', '.join(self.BALANCES)))
+        if not 0 <= shard_index < num_shards:
+            raise ValueError('Shard index {} out of range for {} shards'
+                             .format(shard_index, num_shards))
+        draw = partial(self._draw_batches, sampler, batch_size, **options)
+        if num_shards == 1:
+            return draw
+        groups = self.table.patient if balance == 'patient' else None
+        num_groups = len(np.unique(groups)) if groups is not None\
+            else len(self.table)
+        if num_groups < num_shards:
+            # a shard without records would run no steps at all
+            raise ValueError('Cannot split {} {} into {} non-empty shards'
+                             .format(num_groups, 'patients' if balance ==
+                                     'patient' else 'records', num_shards))
+        weights = self.table.estimated_nbytes(self.scan_workers)\
+            if balance == 'bytes' else None
+
+        def draw_shard(rng=np.random):
+            parts = samplers.partition(len(self.table), num_shards, rng,
+                                       groups, weights)
+            # every shard is drawn, so that all shards consume the random
+            # state alike and can agree on the number of batches
+            shards = [draw(rng=rng, records=part) for part in parts]
+            num_batches = max(len(batches) for batches in shards)
+            own = shards[shard_index]
+            # shards with fewer batches repeat some, so that data parallel
+            # consumers run the same number of steps
+            return [own[k % len(own)] for k in range(num_batches)]\
+                if own else own
+        return draw_shard
+
+    def _epoch_batches(self, sampler, batch_size, seed, epoch, **options):
+        """Draw the batches of one epoch; see _sampler.
+        """
+        check_shard_seed(seed, options.get('num_shards', 1))
+        return self._sampler(sampler, batch_size, **options)(
+            rng=epoch_random_state(seed, epoch))
+
+    def random_shuffled_iterator(self, batch_size=1, tag_records=False,
+                                 stacked=False, seed=None, epoch=0,
+                                 num_shards=1, shard_index=0,
+                                 balance='records', fields=None):
+        """Get an iterator that randomly iterate through the dataset
+
+        :param batch_size: number of records in a batch
+        :param tag_records: yield (tag, data) pairs instead of data
+        :param stacked: yield each batch as a StackedBatch of (B, H, W)
+                        arrays, reused between batches, instead of a list
+        :param seed: optional integer seed; together with epoch it fixes the
+                     order, otherwise the global NumPy random state is used
+        :param epoch: epoch number mixed into the seed
+        :param num_shards: number of disjoint shards the records of every
+                           epoch are split into, e.g. one per data parallel
+                           rank; needs a seed
+        :param shard_index: the shard to iterate over; only its records are
+                            loaded
+        :param balance: how the shards are balanced: 'records' for equal
+                        record counts, 'patient' for equal record counts
+                        with every patient in a single shard, and 'bytes'
+                        for equal estimated data sizes; shards with fewer
+                        batches repeat some so that all shards have the same
+                        number of batches
+        :param fields: a RecordData field name or an iterable of them, None
+                       for all fields; only these are loaded, so e.g.
+                       ('ic_path', 'oc_path') never decodes an image, and the
+                       other fields may be None
+        :return: iterator of batches
+        """
+        # shuffle an index permutation instead of the records themselves
+        batches = self._epoch_batches(
+            'shuffled', batch_size, seed, epoch, num_shards=num_shards,
+            shard_index=shard_index, balance=balance)
+        return self._iterate_batches(batches, batch_size, tag_records,
+                                     stacked, fields)
+
+    def positive_indices(self, positive='icontour'):
+        """Get the indices of the records counted as positive.
+
+        :param positive: 'icontour', 'ocontour', 'any' (either contour), or
+                         'both' (both contours)
+        :return: 2-tuple of index arrays of positive and negative records
+        """
+        everything = slice(None)
+        icontour = self.table.has_file(everything, 1)
+        ocontour = self.table.has_file(everything, 2)
+        masks = {'icontour': icontour, 'ocontour': ocontour,
+                 'any': icontour | ocontour, 'both': icontour & ocontour}
+        if positive not in masks:
+            raise ValueError('Unknown positive class {!r}, expected one of {}'
+                             .format(positive, ', '.join(sorted(masks))))
+        mask = masks[positive]
+        return np.nonzero(mask)[0], np.nonzero(~mask)[0]
+
+    def balanced_iterator(self, batch_size=1, positive_fraction=0.5,
+                          positive='icontour', num_batches=None,
+                          tag_records=False, stacked=False, seed=None,
+                          epoch=0, num_shards=1, shard_index=0,
+                          balance='records', fields=None):
+        """Get an iterator over batches with a fixed share of positive
+        records, i.e. images with contours.
+
+        The classes are told apart by the files found when scanning, so only
+        the records that are drawn are ever loaded; see
+        samplers.balanced_batches.
+
+        :param batch_size: see random_shuffled_iterator
+        :param positive_fraction: share of positive records in every batch
+        :param positive: which records are positive; see positive_indices
+        :param num_batches: number of batches; defaults to one epoch's worth
+        :param tag_records: see random_shuffled_iterator
+        :param stacked: see random_shuffled_iterator
+        :param seed: see random_shuffled_iterator
+        :param epoch: see random_shuffled_iterator
+        :param num_shards: see random_shuffled_iterator
+        :param shard_index: see random_shuffled_iterator
+        :param balance: see random_shuffled_iterator
+        :param fields: see random_shuffled_iterator
+        :return: iterator of batches
+        """
+        batches = self._epoch_batches(
+            'balanced', batch_size, seed, epoch, num_shards=num_shards,
+            shard_index=shard_index, balance=balance, positive=positive,
+            positive_fraction=positive_fraction, num_batches=num_batches)
+        return self._iterate_batches(batches, batch_size, tag_records,
+                                     stacked, fields)
+
+    def shape_bucketed_iterator(self, batch_size=1, tag_records=False,
+                                stacked=False, seed=None, epoch=0,
+                                num_shards=1, shard_index=0,
+                                balance='records', fields=None):
+        """Get an iterator that randomly iterates through the dataset in
+        batches of records of the same image shape.
+
+        The shapes are read from the DICOM headers once; see
+        RecordTable.shapes and samplers.shape_bucketed_batches. Stacked
+        batches then never need padding.
+
+        :param batch_size: see random_shuffled_iterator
+        :param tag_records: see random_shuffled_iterator
+        :param stacked: see random_shuffled_iterator
+        :param seed: see random_shuffled_iterator
+        :param epoch: see random_shuffled_iterator
+        :param num_shards: see random_shuffled_iterator
+        :param shard_index: see random_shuffled_iterator
+        :param balance: see random_shuffled_iterator
+        :param fields: see random_shuffled_iterator
+        :return: iterator of batches
+        """
+        batches = self._epoch_batches(
+            'shape_bucketed', batch_size, seed, epoch, num_shards=num_shards,
+            shard_index=shard_index, balance=balance)
+        return self._iterate_batches(batches, batch_size, tag_records,
+                                     stacked, fields)
+
+    def epoch_iterator(self, batch_size=1, sampler='shuffled', seed=None,
+                       tag_records=False, stacked=False, fields=None,
+                       **options):
+        """Get a resumable iterator over successive epochs.
+
+        usage:
+        epochs = parser.epoch_iterator(batch_size, seed=1234)
+        for epoch in range(num_epochs):
+            for batch in epochs:
+                # do something with batch
+                checkpoint(epochs.get_state())
+
+        :param batch_size: see random_shuffled_iterator
+        :param sampler: one of SAMPLERS
+        :param seed: optional integer seed; a random one is drawn if not
+                     given, so that the state can always be restored.
+                     Required with num_shards > 1
+        :param tag_records: see random_shuffled_iterator
+        :param stacked: see random_shuffled_iterator
+        :param fields: see random_shuffled_iterator
+        :param options: extra arguments of the sampler, including
+                        num_shards, shard_index and balance; see _sampler
+        :return: an EpochIterator object
+        """
+        check_shard_seed(seed, options.get('num_shards', 1))
+        return EpochIterator(self, self._sampler(sampler, batch_size,
+                                                 **options),
+                             batch_size, seed, tag_records, stacked, fields)
+
+    def arandom_shuffled_iterator(self, batch_size=1, tag_records=False,
+                                  stacked=False, seed=None, epoch=0,
+                                  num_shards=1, shard_index=0,
+                                  balance='records', fields=None):
+        """Get an asynchronous iterator that randomly iterates through the
+        dataset, for use with async for in asyncio code.
+
+        The records are loaded on the loader's pool of worker threads or
+        processes, never on the event loop; see _aiterate_batches.
+
+        :param batch_size: see random_shuffled_iterator
+        :param tag_records: see random_shuffled_iterator
+        :param stacked: see random_shuffled_iterator
+        :param seed: see random_shuffled_iterator
+        :param epoch: see random_shuffled_iterator
+        :param num_shards: see random_shuffled_iterator
+        :param shard_index: see random_shuffled_iterator
+        :param balance: see random_shuffled_iterator
+        :param fields: see random_shuffled_iterator
+        :return: asynchronous iterator of batches
+        """
+        batches = self._epoch_batches(
+            'shuffled', batch_size, seed, epoch, num_shards=num_shards,
+            shard_index=shard_index, balance=balance)
+        return self._aiterate_batches(batches, tag_records, stacked, fields)
+
+    def patient_rows(self, order='serial'):
+        """Get the rows of every patient in slice order.
+
+        :param order: 'serial' to order the slices by serial ID, or
+                      'position' to order them by the slice location in the
+                      DICOM headers (read once, see RecordTable.metadata),
+                      with slices of unknown location last
+        :return: list of 2-tuples of (patient ID, original ID) and the index
+                 array of its rows, in link.csv order
+        """
+        if order not in self.ORDERS:
+            raise ValueError('Unknown order {!r}, expected one of {}'.format(
+                order, ', '.join(self.ORDERS)))
+        table = self.table
+        keys = [table.serial_id]
+        if order == 'position':
+            location = table.metadata()['slice_location']
+            keys.append(np.where(np.isnan(location), np.inf, location))
+        keys.append(table.patient)
+        rows = np.lexsort(keys)
+        bounds = np.searchsorted(table.patient[rows],
+                                 np.arange(len(table.patients) + 1))
+        return [(table.patients[p], rows[bounds[p]:bounds[p + 1]])
+                for p in range(len(table.patients))
+                if bounds[p + 1] > bounds[p]]
+
+    def _load_volume(self, ids, rows, fields, volume=None):
+        """Load the given rows of one patient straight into a Volume.
+
+        The arrays are sized from the headers first, and every slice is
+        parsed and written into its place on the loader's workers; slices
+        still resident in the table are copied from there.
+
+        :param ids: 2-tuple of patient ID and original ID
+        :param rows: index array of the slices, in order
+        :param fields: bit mask of the fields to load, see field_mask
+        :param volume: a Volume whose arrays are reused, or None for a new one
+        :return: the Volume
+        """
+        table = self.table
+        volume = Volume() if volume is None else volume
+        meta = table.metadata()[rows]
+        volume.allocate(table.shapes()[rows],
+                        [np.dtype(d) for d in set(meta['dtype']) if d],
+                        fields)
+        volume.patient_id, volume.original_id = ids
+        volume.indices = rows
+        volume.serial_ids = table.serial_id[rows]
+        volume.slice_locations = meta['slice_location']
+
+        def put_slice(k):
+            i = rows[k]
+            data = table.data[i]
+            if data is None or table.missing(i, fields):
+                data = table.read(i, fields)
+            volume.put(k, data)
+        if self.loader == 'thread':
+            list(self._get_executor().map(put_slice, range(len(rows))))
+        elif self.loader == 'process':
+            executor = self._get_executor()
+            futures = dict(
+                (executor.submit(_load_dicom_and_contour_files,
+                                 table.filenames(i), self.cache, fields,
+                                 table.compact), k)
+                for k, i in enumerate(rows))
+            for future in as_completed(futures):
+                volume.put(futures[future], future.result())
+        else:
+            for k in range(len(rows)):
+                put_slice(k)
+        return volume
+
+    def volume(self, patient_id, order='serial', fields=None):
+        """Get the slices of one patient as a (Z, H, W) volume.
+
+        The slices are parsed in parallel with the 'thread' and 'process'
+        loaders, and each is written straight into the preallocated arrays
+        of the volume.
+
+        :param patient_id: the patient ID string
+        :param order: see patient_rows
+        :param fields: see random_shuffled_iterator
+        :return: a Volume object
+        """
+        for ids, rows in self.patient_rows(order):
+            if ids[0] == patient_id:
+                return self._load_volume(ids, rows, field_mask(fields))
+        raise ValueError('Unknown patient {!r}'.format(patient_id))
+
+    def patient_iterator(self, order='serial', fields=None, shuffle=False,
+                         seed=None, epoch=0, reuse=False):
+        """Get an iterator over the volumes of all patients.
+
+        :param order: see patient_rows
+        :param fields: see random_shuffled_iterator
+        :param shuffle: visit the patients in random order instead of
+                        link.csv order
+        :param seed: see random_shuffled_iterator
+        :param epoch: see random_shuffled_iterator
+        :param reuse: yield one Volume object whose arrays are reused by the
+                      next patient, like stacked batches, instead of a new
+                      one per patient
+        :return: iterator of Volume objects
+        """
+        fields = field_mask(fields)
+        patients = self.patient_rows(order)
+        if shuffle:
+            rng = epoch_random_state(seed, epoch)
+            patients = [patients[k] for k in rng.permutation(len(patients))]
+        volume = Volume() if reuse else None
+        for ids, rows in patients:
+            yield self._load_volume(ids, rows, fields, volume)
@@ -0,0 +1,233 @@
+"""instrumentation.py
+
+This module provides optional timing of the stages of the loading pipeline:
+per-stage latency histograms, byte counts, event counters, and hooks called
+on every measurement.
+
+Instrumentation is process-wide and off by default. The hot paths only check
+whether the module's active attribute is None, so disabled instrumentation
+costs one attribute lookup per stage. Stages run in the worker processes of
+the 'process' loader are not measured; the time the consumer waits for them
+is, as the 'stall' stage.
+
+Stages:
+    scan           building a parser's record table, once per parser
+    scan_patient   listing the folders of one patient
+    load_record    loading one record, including all stages below
+    read_dicom     reading and decoding one DICOM file; bytes are the file size
+    rescale        applying the rescale slope and intercept of one image
+    read_contour   reading one contour file; bytes are the file size
+    rasterize      rasterizing one contour into a mask
+    stall          the consumer waiting for the records of one batch
+Counters:
+    slice_cache_hit, slice_cache_miss   lookups in the SliceCache
+    memory_hit                          records found in the MemoryCache
+
+usage:
+stats = instrumentation.enable()
+for batch in parser.random_shuffled_iterator(batch_size):
+    # do something with batch
+print(stats.report())
+instrumentation.disable()
+
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+
+# the Stats object measurements go to, None while disabled
+active = None
+
+# upper bounds in seconds of the histogram buckets: 1 us to about 9 hours in
+# powers of two, and a last bucket for anything longer
+BUCKET_BOUNDS = [1e-6 * 2 ** k for k in range(36)]
+
+
+class Histogram:
+    """Counts, sizes and a log-scale latency histogram of one stage.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.nbytes = 0
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def add(self, seconds, nbytes=0):
+        """Add one measurement.
+
+        :param seconds: duration of the stage
+        :param nbytes: bytes read by the stage
+        """
+        self.count += 1
+        self.total += seconds
+        self.nbytes += nbytes
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+
+    def percentile(self, q):
+        """Estimate a percentile of the durations.
+
+        :param q: percentile between 0 and 100
+        :return: upper bound of the bucket holding the percentile, capped by
+                 the largest duration, 0 if there are no measurements
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, num in zip(BUCKET_BOUNDS, self.buckets):
+            seen += num
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """Get the figures of the stage.
+
+        :return: dictionary of count, total, mean, p50, p90, p99 and max in
+                 seconds, and bytes
+        """
+        return {'count': self.count, 'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'max': self.max,
+                'bytes': self.nbytes}
+
+
+class Stats:
+    """Measurements of the pipeline stages and event counters.
+
+    It is safe to use from several threads at once.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.hooks = []
+        self._lock = Lock()
+
+    def record(self, stage, seconds, nbytes=0):
+        """Add a measurement of a stage and pass it on to the hooks.
+
+        :param stage: stage name
+        :param seconds: duration of the stage
+        :param nbytes: bytes read by the stage
+        """
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.add(seconds, nbytes)
+        for hook in self.hooks:
+            hook(stage, seconds, nbytes)
+
+    def count(self, name, num=1):
+        """Increase an event counter.
+
+        :param name: counter name
+        :param num: increment
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    def add_hook(self, hook):
+        """Call hook(stage, seconds, nbytes) on every measurement.
+
+        Hooks run on the thread that made the measurement, so they should be
+        quick and thread-safe.
+
+        :param hook: a callable
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """Stop calling a hook added with add_hook.
+        """
+        self.hooks.remove(hook)
+
+    def reset(self):
+        """Drop all measurements and counters, keeping the hooks.
+        """
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+
+    def summary(self):
+        """Get the figures of all stages and the counters.
+
+        :return: dictionary of stage name to Histogram.summary(), and
+                 'counters' to a dictionary of the counters
+        """
+        with self._lock:
+            summary = dict((stage, histogram.summary())
+                           for stage, histogram in self.stages.items())
+            summary['counters'] = dict(self.counters)
+        return summary
+
+    def report(self):
+        """Format the summary as a table.
+
+        :return: a multi-line string
+        """
+        summary = self.summary()
+        counters = summary.pop('counters')
+        lines = ['{:14s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>12s}'
+                 .format('stage', 'count', 'total s', 'mean ms', 'p90 ms',
+                         'max ms', 'MiB')]
+        for stage in sorted(summary):
+            s = summary[stage]
+            lines.append('{:14s} {:8d} {:10.3f} {:10.3f} {:10.3f} {:10.3f} '
+                         '{:12.2f}'.format(stage, s['count'], s['total'],
+                                           s['mean'] * 1e3, s['p90'] * 1e3,
+                                           s['max'] * 1e3,
+                                           s['bytes'] / 2 ** 20))
+        for name in sorted(counters):
+            lines.append('{:14s} {:8d}'.format(name, counters[name]))
+        return '\n'.join(lines)
+
+
+def enable(stats=None):
+    """Start sending measurements to a Stats object.
+
+    :param stats: the Stats object to use, a new one if None
+    :return: the active Stats object
+    """
+    global active
+    active = stats if stats is not None else Stats()
+    return active
+
+
+def disable():
+    """Stop measuring.
+
+    :return: the Stats object that was active, or None
+    """
+    global active
+    stats, active = active, None
+    return stats
+
+
+@contextmanager
+def timed(stage):
+    """Measure the body of a with block as one run of a stage, if enabled.
+
+    Meant for stages that run once per batch or less; hot paths check active
+    themselves.
+
+    :param stage: stage name
+    """
+    stats = active
+    if stats is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stats.record(stage, perf_counter() - start)
@@ -0,0 +1,150 @@
+"""masks.py
+
+This module provides a bit-packed representation of Boolean masks, one bit
+per pixel instead of one byte. Masks without any set pixel are not stored at
+all: they are represented by one shared empty mask per shape.
+
+A PackedMask expands to a bool array only when asked to, through unpack,
+np.asarray, or unpack_into a caller's buffer.
+
+"""
+
+from threading import Lock
+
+import numpy as np
+
+
+class PackedMask:
+    """A Boolean mask stored with np.packbits.
+
+    usage:
+    packed = PackedMask.pack(mask)
+    mask = packed.unpack()
+    packed.unpack_into(batch[k, :rows, :cols])
+    """
+
+    __slots__ = ('shape', 'bits')
+
+    dtype = np.dtype(np.bool_)
+    ndim = 2
+
+    def __init__(self, shape, bits=None):
+        """Initialize from packed bits; use pack or empty_mask instead.
+
+        :param shape: (rows, cols) of the mask
+        :param bits: uint8 array of the row-major packed bits, None if no
+                     pixel is set
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.bits = bits
+
+    @classmethod
+    def pack(cls, mask):
+        """Pack a Boolean mask.
+
+        :param mask: 2-D Boolean array
+        :return: a PackedMask, the shared empty one if no pixel is set
+        """
+        mask = np.asarray(mask, dtype=np.bool_)
+        if not mask.any():
+            return empty_mask(mask.shape)
+        return cls(mask.shape, np.packbits(mask, axis=None))
+
+    @classmethod
+    def from_bits(cls, shape, bits):
+        """Wrap bits packed by np.packbits(mask, axis=None).
+
+        :param shape: (rows, cols) of the mask
+        :param bits: uint8 array, used without copying
+        :return: a PackedMask, the shared empty one if no bit is set
+        """
+        if not bits.any():
+            return empty_mask(shape)
+        return cls(shape, bits)
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nbytes(self):
+        """Bytes held by the mask, 0 for empty masks
+        """
+        return self.bits.nbytes if self.bits is not None else 0
+
+    def any(self):
+        return self.bits is not None
+
+    def unpack(self):
+        """Expand to a bool array.
+
+        :return: new (rows, cols) Boolean array
+        """
+        if self.bits is None:
+            return np.zeros(self.shape, dtype=np.bool_)
+        return np.unpackbits(self.bits)[:self.size].view(np.bool_)\
+            .reshape(self.shape)
+
+    def unpack_into(self, out):
+        """Expand into an existing array, e.g. a slice of a batch buffer.
+
+        :param out: writable array of the mask's shape
+        """
+        if self.bits is None:
+            out[...] = False
+        else:
+            out[...] = np.unpackbits(self.bits)[:self.size]\
+                .view(np.bool_).reshape(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.unpack()
+        return mask if dtype is None else mask.astype(dtype, copy=False)
+
+    def __eq__(self, other):
+        if isinstance(other, PackedMask):
+            return self.shape == other.shape and\
+                np.array_equal(self.unpack(), other.unpack())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'PackedMask(shape={}, nbytes={})'.format(self.shape,
+                                                        self.nbytes)
+
+    def __reduce__(self):
+        # empty masks stay shared after a trip to another process
+        if self.bits is None:
+            return empty_mask, (self.shape,)
+        return PackedMask, (self.shape, self.bits)
+
+
+# shape -> the shared empty mask of that shape
+_EMPTY = {}
+_EMPTY_LOCK = Lock()
+
+
+def empty_mask(shape):
+    """Get the shared mask without any set pixel of a shape.
+
+    :param shape: (rows, cols)
+    :return: a PackedMask
+    """
+    shape = tuple(int(n) for n in shape)
+    mask = _EMPTY.get(shape)
+    if mask is None:
+        with _EMPTY_LOCK:
+            mask = _EMPTY.setdefault(shape, PackedMask(shape))
+    return mask
+
+
+def compact_masks(data):
+    """Pack the masks of a record.
+
+    :param data: a RecordData tuple
+    :return: a RecordData tuple with PackedMask masks
+    """
+    return data._replace(**dict(
+        (name, PackedMask.pack(getattr(data, name)))
+        for name in ('ic_mask', 'oc_mask')
+        if isinstance(getattr(data, name), np.ndarray)))
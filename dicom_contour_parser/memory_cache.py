@@ -0,0 +1,138 @@
+"""memory_cache.py
+
+This module provides the bookkeeping of an in-process, least recently used
+cache of loaded records with a byte budget. The data itself stays in the
+record table; the cache only decides which rows to evict.
+
+"""
+
+from threading import Lock
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from . import instrumentation
+from .masks import PackedMask
+
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'evictions',
+                                       'nbytes', 'max_bytes'])
+
+
+def data_nbytes(data):
+    """Get the number of bytes held by the arrays of a record.
+
+    :param data: a RecordData tuple
+    :return: the sum of nbytes over its ndarray and PackedMask fields
+    """
+    return sum(value.nbytes for value in data
+               if isinstance(value, (np.ndarray, PackedMask)))
+
+
+class MemoryCache:
+    """Recency order and size of the resident rows of a record table.
+
+    usage:
+    memory = MemoryCache(4e9)
+    if not memory.hit(index):
+        data[index] = load(index)
+        for evicted in memory.add(index, data_nbytes(data[index])):
+            data[evicted] = None
+    """
+
+    def __init__(self, max_bytes):
+        """Initialize with the byte budget.
+
+        :param max_bytes: the largest total size of the resident rows
+        """
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # row index -> nbytes, least recently used first
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, index):
+        return index in self._entries
+
+    def hit(self, index):
+        """Mark a row as used if it is resident.
+
+        :param index: row index
+        :return: True if the row is resident, counted as a hit
+        """
+        with self._lock:
+            if index not in self._entries:
+                return False
+            self._entries.move_to_end(index)
+            self.hits += 1
+        stats = instrumentation.active
+        if stats is not None:
+            stats.count('memory_hit')
+        return True
+
+    def add(self, index, nbytes, keep=None):
+        """Add a freshly loaded row, counted as a miss.
+
+        :param index: row index
+        :param nbytes: size of the row's data
+        :param keep: optional predicate on row indices; rows for which it is
+                     true are never evicted, even if that leaves the cache
+                     over budget
+        :return: list of row indices to evict, which may include index itself
+                 if it alone exceeds the budget
+        """
+        with self._lock:
+            self.misses += 1
+            self.nbytes -= self._entries.pop(index, 0)
+            self._entries[index] = nbytes
+            self.nbytes += nbytes
+            return self._evict(keep)
+
+    def evict(self, keep=None):
+        """Evict the least recently used rows until the cache is within its
+        budget, e.g. once rows kept by add are released.
+
+        :param keep: see add
+        :return: list of row indices to evict
+        """
+        with self._lock:
+            return self._evict(keep)
+
+    def _evict(self, keep):
+        """Pick the rows to evict; the lock must be held.
+        """
+        evicted = []
+        if self.nbytes <= self.max_bytes:
+            return evicted
+        for key in list(self._entries):
+            if self.nbytes <= self.max_bytes:
+                break
+            if keep is not None and keep(key):
+                continue
+            self.nbytes -= self._entries.pop(key)
+            self.evictions += 1
+            evicted.append(key)
+        return evicted
+
+    def discard(self, index):
+        """Forget a row that was cleared by other means.
+
+        :param index: row index
+        """
+        with self._lock:
+            self.nbytes -= self._entries.pop(index, 0)
+
+    def stats(self):
+        """Get the counters of the cache.
+
+        :return: a CacheStats tuple
+        """
+        with self._lock:
+            return CacheStats(self.hits, self.misses, self.evictions,
+                              self.nbytes, self.max_bytes)
@@ -0,0 +1,178 @@
+"""metrics.py
+
+This module provides segmentation metrics computed over whole batches of
+masks at once, and a streaming intensity ROC of the blood pool against the
+heart muscle.
+
+The blood pool of a record is its i-contour mask, and the muscle is the part
+of its o-contour mask outside of the i-contour. IntensityROC keeps one fixed
+bin histogram of pixel values per region, so its memory does not grow with
+the number of records evaluated.
+
+usage:
+roc = IntensityROC()
+for batch in parser.random_shuffled_iterator(batch_size, stacked=True):
+    roc.update(batch)
+curve = roc.curve()
+threshold = roc.best_threshold()
+
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+
+ConfusionCounts = namedtuple('ConfusionCounts', ['true_pos', 'false_pos',
+                                                 'false_neg', 'true_neg'])
+
+ROCCurve = namedtuple('ROCCurve', ['thresholds', 'tpr', 'fpr'])
+
+
+def _as_stack(mask):
+    """View a (H, W) mask or a (B, H, W) stack of masks as a boolean stack
+    """
+    mask = np.asarray(mask, dtype=np.bool_)
+    return mask[np.newaxis] if mask.ndim == 2 else mask
+
+
+def confusion_counts(predicted, truth, region=None):
+    """Count the pixel outcomes of every mask of a stack.
+
+    :param predicted: (B, H, W) or (H, W) Boolean predicted masks
+    :param truth: Boolean ground truth masks of the same shape
+    :param region: optional Boolean masks of the same shape; pixels outside
+                   of them are not counted
+    :return: ConfusionCounts of (B,) integer arrays
+    """
+    predicted, truth = _as_stack(predicted), _as_stack(truth)
+    if region is not None:
+        region = _as_stack(region)
+        predicted = predicted & region
+        truth = truth & region
+    axes = (1, 2)
+    true_pos = np.count_nonzero(predicted & truth, axis=axes)
+    num_pred = np.count_nonzero(predicted, axis=axes)
+    num_truth = np.count_nonzero(truth, axis=axes)
+    if region is not None:
+        total = np.count_nonzero(region, axis=axes)
+    else:
+        total = np.full(len(truth), truth[0].size if len(truth) else 0)
+    false_pos = num_pred - true_pos
+    false_neg = num_truth - true_pos
+    return ConfusionCounts(true_pos, false_pos, false_neg,
+                           total - true_pos - false_pos - false_neg)
+
+
+def dice(predicted, truth, region=None):
+    """Compute the Dice coefficient of every mask of a stack.
+
+    :param predicted: see confusion_counts
+    :param truth: see confusion_counts
+    :param region: see confusion_counts
+    :return: (B,) float array; 1 where both masks are empty
+    """
+    counts = confusion_counts(predicted, truth, region)
+    denominator = 2 * counts.true_pos + counts.false_pos + counts.false_neg
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0,
+                        2 * counts.true_pos / np.maximum(denominator, 1), 1.0)
+
+
+class IntensityROC:
+    """Streaming histograms of the pixel values of the blood pool and the
+    muscle, and the ROC curve of telling them apart by a threshold.
+
+    A pixel is classified as blood if its value is at or above the
+    threshold. Values outside of value_range are counted in the first or last
+    bin.
+    """
+
+    def __init__(self, bins=4096, value_range=(0, 4096)):
+        """Initialize empty histograms.
+
+        :param bins: number of bins; with the default range every integer
+                     value of 12 bit images has a bin of its own
+        :param value_range: (low, high) pixel values covered by the bins
+        """
+        self.bins = int(bins)
+        self.low, self.high = value_range
+        self.edges = np.linspace(self.low, self.high, self.bins + 1)
+        self.blood = np.zeros(self.bins, dtype=np.int64)
+        self.muscle = np.zeros(self.bins, dtype=np.int64)
+
+    def _bin(self, values):
+        """Get the bin index of every value
+        """
+        scaled = (values - self.low) * (self.bins / (self.high - self.low))
+        return np.clip(np.floor(scaled), 0, self.bins - 1).astype(np.intp)
+
+    def update_arrays(self, images, ic_masks, oc_masks):
+        """Add the pixels of a stack of images.
+
+        :param images: (B, H, W) or (H, W) pixel values
+        :param ic_masks: Boolean i-contour masks of the same shape
+        :param oc_masks: Boolean o-contour masks of the same shape
+        """
+        images = np.asarray(images)
+        ic_masks = np.asarray(ic_masks, dtype=np.bool_)
+        oc_masks = np.asarray(oc_masks, dtype=np.bool_)
+        self.blood += np.bincount(self._bin(images[ic_masks]),
+                                  minlength=self.bins)
+        self.muscle += np.bincount(self._bin(images[oc_masks & ~ic_masks]),
+                                   minlength=self.bins)
+
+    def update(self, batch):
+        """Add the pixels of a batch of records.
+
+        :param batch: a StackedBatch, or an iterable of RecordData; records
+                      without an image or masks are skipped
+        :raises ValueError: if a StackedBatch was loaded without the images
+                            or masks, e.g. by an iterator given fields
+        """
+        if hasattr(batch, 'images'):
+            missing = [name for name in ('images', 'ic_masks', 'oc_masks')
+                       if getattr(batch, name) is None]
+            if missing:
+                raise ValueError('The batch has no {}; load it with the '
+                                 'dicom, ic_mask and oc_mask fields'
+                                 .format(', '.join(missing)))
+            self.update_arrays(batch.images, batch.ic_masks, batch.oc_masks)
+            return
+        for data in batch:
+            if data.dicom is None or data.ic_mask is None or\
+               data.oc_mask is None:
+                continue
+            self.update_arrays(data.dicom, data.ic_mask, data.oc_mask)
+
+    def curve(self):
+        """Get the ROC curve at every bin edge.
+
+        :return: ROCCurve of (bins + 1,) arrays, from threshold low (every
+                 pixel is blood) to high (no pixel is)
+        """
+        # pixels at or above each edge
+        above_blood = np.append(np.cumsum(self.blood[::-1])[::-1], 0)
+        above_muscle = np.append(np.cumsum(self.muscle[::-1])[::-1], 0)
+        num_blood = max(int(above_blood[0]), 1)
+        num_muscle = max(int(above_muscle[0]), 1)
+        return ROCCurve(self.edges, above_blood / num_blood,
+                        above_muscle / num_muscle)
+
+    def auc(self):
+        """Get the area under the ROC curve.
+
+        :return: float between 0 and 1
+        """
+        curve = self.curve()
+        # the curve runs from (1, 1) down to (0, 0)
+        return float(np.sum((curve.fpr[:-1] - curve.fpr[1:]) *
+                            (curve.tpr[:-1] + curve.tpr[1:]) / 2))
+
+    def best_threshold(self):
+        """Get the threshold with the largest TPR - FPR.
+
+        :return: the bin edge value
+        """
+        curve = self.curve()
+        return float(curve.thresholds[np.argmax(curve.tpr - curve.fpr)])
@@ -0,0 +1,319 @@
+"""packed.py
+
+This module provides a packed, single-file format for a whole data set, and a
+reader that serves the records straight from a memory map of that file.
+
+A packed file is written once by compile_dataset and holds, in this order:
+    - the image stack: every DICOM image as raw bytes
+    - the masks: every i-contour and o-contour mask, bit-packed
+    - the contour paths: every contour as float64 (x, y) pairs
+    - the offsets table: one fixed-size row per record, see RECORD_DTYPE
+    - a JSON header with the section offsets, the patient table, and the
+      image data types
+The first bytes of the file hold a magic string and the header location.
+
+"""
+
+import json
+import struct
+import shutil
+import tempfile
+import os.path as opath
+
+import numpy as np
+
+from .dicom_contour_parser import (ALL_FIELDS, FIELD_BITS, METADATA_DTYPE,
+                                   DicomContourParser, RecordData, RecordList,
+                                   RecordTable)
+from .masks import PackedMask
+
+
+MAGIC = b'DCPPACK2'
+PREFIX = struct.Struct('<8sQQ')
+ALIGNMENT = 64
+
+HAS_DICOM = 1
+HAS_ICONTOUR = 2
+HAS_OCONTOUR = 4
+
+RECORD_DTYPE = np.dtype([
+    ('patient', '<i4'),         # index into the header's patient table
+    ('serial_id', '<i4'),
+    ('flags', 'u1'),            # HAS_* bits
+    ('dtype', 'u1'),            # index into the header's dtype table
+    ('rows', '<i4'),
+    ('cols', '<i4'),
+    ('image_offset', '<i8'),    # byte offset in the image stack, -1 if none
+    ('ic_offset', '<i8'),       # byte offset in the masks, -1 if none
+    ('oc_offset', '<i8'),
+    ('ic_path_offset', '<i8'),  # point offset in the contour paths
+    ('ic_path_len', '<i4'),
+    ('oc_path_offset', '<i8'),
+    ('oc_path_len', '<i4'),
+    ('slice_location', '<f8'),  # from the DICOM header, NaN if unknown
+])
+
+
+def _pad(f, alignment=ALIGNMENT):
+    """Pad the file with zeros up to the next multiple of alignment.
+
+    :return: the new file position
+    """
+    pos = f.tell()
+    padding = -pos % alignment
+    if padding:
+        f.write(b'\0' * padding)
+    return pos + padding
+
+
+def compile_dataset(parser, output_file, batch_size=100):
+    """Write all records of a parser into a single packed file.
+
+    The records are loaded batch by batch with the parser's own loader, so a
+    'process' loader or a cache speeds up compiling as well.
+
+    :param parser: a DicomContourParser object
+    :param output_file: path string of the packed file to write
+    :param batch_size: number of records loaded at once
+    """
+    source = parser.table
+    dtypes = []
+    table = np.zeros(len(source), dtype=RECORD_DTYPE)
+    table['patient'] = source.patient
+    table['serial_id'] = source.serial_id
+    table['flags'] = (HAS_DICOM * source.has_file(slice(None), 0) |
+                      HAS_ICONTOUR * source.has_file(slice(None), 1) |
+                      HAS_OCONTOUR * source.has_file(slice(None), 2))
+    table['slice_location'] = source.metadata()['slice_location']
+    out_dir = opath.dirname(opath.abspath(output_file))
+    with open(output_file, 'wb') as f, \
+            tempfile.TemporaryFile(dir=out_dir) as mask_f, \
+            tempfile.TemporaryFile(dir=out_dir) as path_f:
+        f.write(b'\0' * PREFIX.size)
+        images_start = _pad(f)
+        num_points = 0
+        for low in range(0, len(source), batch_size):
+            batch = np.arange(low, min(low + batch_size, len(source)))
+            parser._prepare_batch_data(batch)
+            for i in batch:
+                data = source.get(i)
+                row = table[i]
+                shape = next((a.shape for a in data[:3] if a is not None),
+                             (0, 0))
+                row['rows'], row['cols'] = shape
+                if data.dicom is not None:
+                    dtype = data.dicom.dtype.str
+                    if dtype not in dtypes:
+                        dtypes.append(dtype)
+                    row['dtype'] = dtypes.index(dtype)
+                    row['image_offset'] = _pad(f) - images_start
+                    f.write(np.ascontiguousarray(data.dicom).tobytes())
+                else:
+                    row['image_offset'] = -1
+                for name, mask in (('ic', data.ic_mask), ('oc', data.oc_mask)):
+                    if mask is not None:
+                        row[name + '_offset'] = mask_f.tell()
+                        mask_f.write(np.packbits(mask, axis=None).tobytes())
+                    else:
+                        row[name + '_offset'] = -1
+                for name, path in (('ic', data.ic_path),
+                                   ('oc', data.oc_path)):
+                    points = np.asarray(path, dtype='<f8').reshape(-1, 2)
+                    row[name + '_path_offset'] = num_points
+                    row[name + '_path_len'] = len(points)
+                    path_f.write(points.tobytes())
+                    num_points += len(points)
+            parser._invalidate_batch_data(batch)
+        sections = {'images': [images_start, f.tell() - images_start]}
+        for name, section_f in (('masks', mask_f), ('paths', path_f)):
+            start = _pad(f)
+            section_f.seek(0)
+            shutil.copyfileobj(section_f, f)
+            sections[name] = [start, f.tell() - start]
+        start = _pad(f)
+        f.write(table.tobytes())
+        sections['records'] = [start, f.tell() - start]
+        header = json.dumps({
+            'num_records': len(table), 'sections': sections,
+            'patients': source.patients,
+            'dtypes': dtypes}).encode('utf-8')
+        header_offset = _pad(f)
+        f.write(header)
+        f.seek(0)
+        f.write(PREFIX.pack(MAGIC, header_offset, len(header)))
+
+
+class PackedTable(RecordTable):
+    """The record table of a PackedDataset.
+
+    Rows are served from the offsets table of the packed file instead of
+    from DICOM and contour files.
+    """
+
+    def __init__(self, dataset, header, memory=None, compact=False):
+        """Initialize from the offsets table of a packed file.
+
+        :param dataset: the PackedDataset object holding this table
+        :param header: the header dictionary of the packed file
+        :param memory: see RecordTable
+        :param compact: see RecordTable
+        """
+        super().__init__(memory=memory, compact=compact)
+        self.dataset = dataset
+        self.patients = [tuple(p) for p in header['patients']]
+        self.patient = dataset.offsets['patient']
+        self.serial_id = dataset.offsets['serial_id']
+        self.flags = dataset.offsets['flags']
+        self.shape = np.stack((dataset.offsets['rows'],
+                               dataset.offsets['cols']), axis=1)
+        # only what the offsets table knows, the rescale parameters are not
+        # kept in packed files
+        offsets = dataset.offsets
+        self.meta = np.zeros(len(offsets), dtype=METADATA_DTYPE)
+        self.meta['valid'] = offsets['image_offset'] >= 0
+        self.meta['rows'] = offsets['rows']
+        self.meta['cols'] = offsets['cols']
+        dtypes = np.array(header['dtypes'] + [''])
+        self.meta['dtype'] = np.where(self.meta['valid'],
+                                      dtypes[offsets['dtype']], '')
+        self.meta['slice_location'] = offsets['slice_location']
+        for name in ('slope', 'intercept'):
+            self.meta[name] = np.nan
+        self.data = np.empty(len(self.patient), dtype=object)
+        self.slot = np.full(len(self.patient), -1, dtype=np.int32)
+        self.state = np.zeros(len(self.patient), dtype=np.uint8)
+        self.pins = np.zeros(len(self.patient), dtype=np.int32)
+        self.clear_pending = np.zeros(len(self.patient), dtype=np.bool_)
+        self.fields = np.zeros(len(self.patient), dtype=np.uint8)
+
+    def filenames(self, index):
+        """Packed records have no source files.
+        """
+        return None
+
+    def read_metadata(self, index):
+        """Get the metadata of a row from the offsets table.
+        """
+        return self.meta[index]
+
+    def has_file(self, index, kind):
+        """Check if a row had a file of the given kind when compiled.
+
+        :param index: row index, or an index array
+        :param kind: 0 for DICOM, 1 for i-contour, 2 for o-contour
+        :return: boolean, or boolean array
+        """
+        return (self.flags[index] & (1 << kind)) != 0
+
+    def read(self, index, fields=ALL_FIELDS):
+        """Build the data of a row from views over the memory mapped file.
+
+        :param index: row index
+        :param fields: see RecordTable.read
+        :return: 5-tuple (RecordData)
+        """
+        return self.dataset.read_record(index, fields, self.compact)
+
+
+class PackedDataset(DicomContourParser):
+    """A data set read from a file written by compile_dataset.
+
+    It has the same record_list and random_shuffled_iterator interface as
+    DicomContourParser, without walking the data folder.
+
+    usage:
+    compile_dataset(DicomContourParser('/path/to/data/folder'),
+                    '/path/to/data.pack')
+    dataset = PackedDataset('/path/to/data.pack')
+    for batch in dataset.random_shuffled_iterator(batch_size):
+        # do something with batch
+    """
+
+    # records are views over the memory map, there is nothing to offload to
+    # worker processes
+    LOADERS = ('sync', 'thread')
+
+    def __init__(self, packed_file, async_load=False, loader=None,
+                 max_cache_bytes=None, prefetch_depth=1, compact_masks=False):
+        """Open a packed file.
+
+        :param packed_file: path string of the packed file
+        :param async_load: see DicomContourParser
+        :param loader: one of 'sync' and 'thread'; see DicomContourParser
+        :param max_cache_bytes: see DicomContourParser
+        :param prefetch_depth: see DicomContourParser
+        :param compact_masks: see DicomContourParser; the masks are then
+                              served straight from the packed bits in the
+                              file
+        :return: a PackedDataset object
+        """
+        self._setup_loader(async_load, loader, None,
+                           max_cache_bytes=max_cache_bytes,
+                           prefetch_depth=prefetch_depth)
+        self.cache = None
+        self.scan_workers = None
+        self.scan_report = None
+        self.scan_index = None
+        self.packed_file = packed_file
+        # copy-on-write, so that consumers can modify the arrays in memory
+        self.mm = np.memmap(packed_file, dtype=np.uint8, mode='c')\
+            .view(np.ndarray)
+        magic, header_offset, header_len = PREFIX.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError('{} is not a packed data set'.format(packed_file))
+        header = json.loads(
+            self.mm[header_offset:header_offset + header_len].tobytes()
+            .decode('utf-8'))
+        self.dtypes = [np.dtype(d) for d in header['dtypes']]
+        self.sections = dict((name, self.mm[start:start + nbytes])
+                             for name, (start, nbytes)
+                             in header['sections'].items())
+        self.offsets = self.sections['records'].view(RECORD_DTYPE)
+        self.points = self.sections['paths'].view('<f8').reshape(-1, 2)
+        self.table = PackedTable(self, header, self.memory_cache,
+                                 compact_masks)
+        self.id_list = list(self.table.patients)
+        self.record_list = RecordList(self.table)
+
+    def read_record(self, index, fields=ALL_FIELDS, compact=False):
+        """Read one record.
+
+        :param index: integer row index in the offsets table
+        :param fields: bit mask of the fields to read, see field_mask; the
+                       others are None
+        :param compact: return the masks as PackedMask objects over the file
+                        instead of unpacking them
+        :return: 5-tuple (RecordData) with the image and the contour paths as
+                 views over the file and the masks unpacked
+        """
+        row = self.offsets[index]
+        shape = (int(row['rows']), int(row['cols']))
+        size = shape[0] * shape[1]
+        dicom = None
+        if row['image_offset'] >= 0 and fields & FIELD_BITS['dicom']:
+            dtype = self.dtypes[row['dtype']]
+            start = int(row['image_offset'])
+            end = start + size * dtype.itemsize
+            dicom = self.sections['images'][start:end].view(dtype)\
+                .reshape(shape)
+        masks = []
+        for name in ('ic', 'oc'):
+            start = int(row[name + '_offset'])
+            if start >= 0 and fields & FIELD_BITS[name + '_mask']:
+                packed = self.sections['masks'][start:start + (size + 7) // 8]
+                if compact:
+                    masks.append(PackedMask.from_bits(shape, packed))
+                    continue
+                masks.append(np.unpackbits(packed)[:size]
+                             .view(np.bool_).reshape(shape))
+            else:
+                masks.append(None)
+        paths = []
+        for name in ('ic', 'oc'):
+            if not fields & FIELD_BITS[name + '_path']:
+                paths.append(None)
+                continue
+            start = int(row[name + '_path_offset'])
+            paths.append(
+                self.points[start:start + int(row[name + '_path_len'])])
+        return RecordData(dicom, masks[0], masks[1], paths[0], paths[1])
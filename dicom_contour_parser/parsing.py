@@ -1,11 +1,17 @@
 """Parsing code for DICOMS and contour files"""
 
+import os
+import re
+from time import perf_counter
+
 import dicom
 from dicom.errors import InvalidDicomError
 
 import numpy as np
 from PIL import Image, ImageDraw
 
+from . import instrumentation
+
 
 def parse_contour_file(filename):
     """Parse the given contour filename
@@ -30,6 +36,35 @@ def parse_contour_file(filename):
     return coords_lst
 
 
+# a line holding anything but whitespace
+_NONBLANK_LINE = re.compile(r'^[ \t\r\f\v]*\S', re.MULTILINE)
+
+
+def parse_contour_array(filename, dtype=np.float64):
+    """Parse the given contour filename in bulk into an array
+
+    Blank lines are skipped like in parse_contour_file. Files that do not
+    hold exactly two coordinates per line fall back to parse_contour_file.
+
+    :param filename: filepath to the contourfile to parse
+    :param dtype: floating point type of the result
+    :return: array of shape (N, 2) holding x, y coordinates of the contour
+    """
+
+    stats = instrumentation.active
+    if stats is not None:
+        start = perf_counter()
+    with open(filename, 'r') as infile:
+        text = infile.read()
+    if stats is not None:
+        stats.record('read_contour', perf_counter() - start, len(text))
+    tokens = text.split()
+    if len(tokens) != 2 * len(_NONBLANK_LINE.findall(text)):
+        return np.array(parse_contour_file(filename),
+                        dtype=dtype).reshape(-1, 2)
+    return np.array(tokens, dtype=dtype).reshape(-1, 2)
+
+
 def parse_dicom_file(filename):
     """Parse the given DICOM filename
 
@@ -37,9 +72,15 @@ def parse_dicom_file(filename):
     :return: dictionary with DICOM image data
     """
 
+    stats = instrumentation.active
     try:
+        if stats is not None:
+            start = perf_counter()
         dcm = dicom.read_file(filename)
         dcm_image = dcm.pixel_array
+        if stats is not None:
+            stats.record('read_dicom', perf_counter() - start,
+                         os.path.getsize(filename))
 
         try:
             intercept = dcm.RescaleIntercept
@@ -51,25 +92,77 @@ def parse_dicom_file(filename):
             slope = 0.0
 
         if intercept != 0.0 and slope != 0.0:
+            if stats is not None:
+                start = perf_counter()
             dcm_image = dcm_image*slope + intercept
+            if stats is not None:
+                stats.record('rescale', perf_counter() - start)
         dcm_dict = {'pixel_data': dcm_image}
         return dcm_dict
     except InvalidDicomError:
         return None
 
 
+def parse_dicom_metadata(filename):
+    """Read the image metadata from the header of the given DICOM file,
+    without reading or decoding the pixel data
+
+    :param filename: filepath to the DICOM file to parse
+    :return: dictionary with the rows, cols, and dtype of the pixel data that
+             parse_dicom_file returns, the rescale slope and intercept, and
+             the slice location (NaN if absent), or None if the file is not
+             valid DICOM
+    """
+
+    try:
+        dcm = dicom.read_file(filename, stop_before_pixels=True)
+        rows, cols = int(dcm.Rows), int(dcm.Columns)
+        bits = int(dcm.BitsAllocated)
+        signed = int(dcm.PixelRepresentation) == 1
+    except (InvalidDicomError, AttributeError):
+        return None
+
+    try:
+        intercept = float(dcm.RescaleIntercept)
+    except AttributeError:
+        intercept = 0.0
+    try:
+        slope = float(dcm.RescaleSlope)
+    except AttributeError:
+        slope = 0.0
+    try:
+        slice_location = float(dcm.SliceLocation)
+    except AttributeError:
+        slice_location = float('nan')
+
+    dtype = np.dtype('{}{}'.format('i' if signed else 'u', max(bits // 8, 1)))
+    if intercept != 0.0 and slope != 0.0:
+        # parse_dicom_file rescales the pixel data
+        dtype = np.dtype(np.float64)
+    return {'rows': rows, 'cols': cols, 'dtype': dtype, 'slope': slope,
+            'intercept': intercept, 'slice_location': slice_location}
+
+
 def poly_to_mask(polygon, width, height):
     """Convert polygon to mask
 
     :param polygon: list of pairs of x, y coords [(x1, y1), (x2, y2), ...]
-     in units of pixels
+     or (N, 2) array in units of pixels
     :param width: scalar image width
     :param height: scalar image height
     :return: Boolean mask of shape (height, width)
     """
 
+    stats = instrumentation.active
+    if stats is not None:
+        start = perf_counter()
+    if isinstance(polygon, np.ndarray):
+        # PIL does not take 2-D arrays, but takes a flat coordinate list
+        polygon = polygon.ravel().tolist()
     # http://stackoverflow.com/a/3732128/1410871
     img = Image.new(mode='L', size=(width, height), color=0)
     ImageDraw.Draw(img).polygon(xy=polygon, outline=0, fill=1)
     mask = np.array(img).astype(bool)
+    if stats is not None:
+        stats.record('rasterize', perf_counter() - start)
     return mask
@@ -0,0 +1,153 @@
+"""samplers.py
+
+This module provides functions that split the records of a data set into
+batches of record indices, in the order an iterator should yield them.
+
+"""
+
+import numpy as np
+
+
+def shuffled_batches(records, batch_size, rng=np.random):
+    """Split a random permutation of the records into batches.
+
+    :param records: number of records in the data set, or an index array of
+                    the records to use
+    :param batch_size: number of records in a batch; the last batch may be
+                       smaller
+    :param rng: an object with a permutation method, such as np.random or a
+                np.random.Generator
+    :return: list of index arrays
+    """
+    order = rng.permutation(records)
+    return [order[low:low + batch_size]
+            for low in range(0, len(order), batch_size)]
+
+
+def shape_bucketed_batches(shapes, batch_size, rng=np.random):
+    """Split the records into batches of records of equal image shape.
+
+    The records are grouped into one bucket per shape and shuffled within
+    their bucket, each bucket is split into batches, and the batches of all
+    buckets are interleaved in random order.
+
+    :param shapes: (N, 2) array of the image shape of every record
+    :param batch_size: number of records in a batch; the last batch of each
+                       bucket may be smaller
+    :param rng: see shuffled_batches
+    :return: list of index arrays
+    """
+    shapes = np.asarray(shapes).reshape(-1, 2)
+    if not len(shapes):
+        return []
+    _, bucket = np.unique(shapes, axis=0, return_inverse=True)
+    bucket = bucket.ravel()
+    batches = []
+    for b in range(bucket.max() + 1):
+        members = np.nonzero(bucket == b)[0]
+        members = members[rng.permutation(len(members))]
+        batches.extend(members[low:low + batch_size]
+                       for low in range(0, len(members), batch_size))
+    return [batches[k] for k in rng.permutation(len(batches))]
+
+
+def _draw(indices, count, rng):
+    """Draw count indices by walking through random permutations of indices,
+    starting a new permutation whenever one is used up
+    """
+    if count == 0:
+        return np.zeros(0, dtype=np.intp)
+    if not len(indices):
+        raise ValueError('Cannot draw from an empty class of records')
+    num_rounds = -(-count // len(indices))
+    return np.concatenate([indices[rng.permutation(len(indices))]
+                           for _ in range(num_rounds)])[:count]
+
+
+def balanced_batches(positive, negative, batch_size, positive_fraction=0.5,
+                     num_batches=None, rng=np.random):
+    """Draw batches holding a fixed share of positive records.
+
+    Each class is drawn from its own shuffled stream, which starts over when
+    it is used up, so the smaller class is oversampled. Records are in random
+    order within each batch.
+
+    :param positive: index array of the positive records
+    :param negative: index array of the negative records
+    :param batch_size: number of records in a batch
+    :param positive_fraction: share of positive records in every batch,
+                              rounded to whole records
+    :param num_batches: number of batches to draw; defaults to as many as
+                        cover every record once on average
+    :param rng: see shuffled_batches
+    :return: list of index arrays
+    """
+    positive = np.asarray(positive, dtype=np.intp)
+    negative = np.asarray(negative, dtype=np.intp)
+    num_positive = int(round(batch_size * positive_fraction))
+    num_negative = batch_size - num_positive
+    if num_batches is None:
+        num_batches = -(-(len(positive) + len(negative)) // batch_size)
+    batches = np.concatenate((
+        _draw(positive, num_positive * num_batches, rng)
+        .reshape(num_batches, num_positive),
+        _draw(negative, num_negative * num_batches, rng)
+        .reshape(num_batches, num_negative)), axis=1)
+    return [batch[rng.permutation(batch_size)] for batch in batches]
+
+
+def partition(num_records, num_shards, rng=np.random, groups=None,
+              weights=None):
+    """Split the records into disjoint shards of about equal weight.
+
+    The groups are put in random order and cut into num_shards consecutive
+    runs of about equal total weight, so a shard is off by at most one group.
+    Every shard gets at least one group, even when heavy groups would leave
+    one empty. With the same random state, every caller gets the same
+    partition.
+
+    :param num_records: number of records in the data set
+    :param num_shards: number of shards
+    :param rng: see shuffled_batches
+    :param groups: optional array of the group, e.g. the patient, of every
+                   record; the records of a group end up in the same shard
+    :param weights: optional array of the weight, e.g. the size, of every
+                    record; records count one each by default
+    :return: list of num_shards non-empty index arrays, each in random order
+    :raises ValueError: if there are fewer groups than shards
+    """
+    if groups is None:
+        groups = np.arange(num_records)
+    if weights is None:
+        weights = np.ones(num_records)
+    _, group = np.unique(groups, return_inverse=True)
+    group = group.ravel()
+    group_weights = np.bincount(group, weights=weights)
+    num_groups = len(group_weights)
+    if num_groups < num_shards:
+        raise ValueError('Cannot split {} groups into {} non-empty shards'
+                         .format(num_groups, num_shards))
+    order = rng.permutation(num_groups)
+    ordered_weights = group_weights[order]
+    ends = np.cumsum(ordered_weights)
+    total = ends[-1] if len(ends) else 0
+    # a group goes to the shard its middle falls into
+    group_shard = np.zeros(len(order), dtype=np.intp)
+    if total > 0:
+        middles = ends - ordered_weights / 2
+        shards = np.minimum((middles * num_shards / total).astype(np.intp),
+                            num_shards - 1)
+        if len(np.unique(shards)) < num_shards:
+            # heavy groups skipped a shard: move on by at most one shard per
+            # group, and soon enough to reach the last shard
+            previous = -1
+            for k in range(num_groups):
+                previous = max(min(max(shards[k], previous), previous + 1),
+                               num_shards - num_groups + k)
+                shards[k] = previous
+        group_shard[order] = shards
+    else:
+        group_shard[order] = np.arange(num_groups) * num_shards // num_groups
+    records = rng.permutation(num_records)
+    record_shard = group_shard[group[records]]
+    return [records[record_shard == k] for k in range(num_shards)]
@@ -0,0 +1,125 @@
+"""scan_index.py
+
+This module provides a persistent index of a scanned data folder, so that a
+parser only rescans the patient folders that changed since its last run.
+
+The index is a JSON file holding, for every (patient ID, original ID) pair of
+link.csv, the modification times of the patient's DICOM, i-contour and
+o-contour folders and the rows found in them. Adding or removing a file
+changes the modification time of its folder, which makes the entry stale.
+Pairs added to link.csv have no entry yet and are scanned as well.
+
+"""
+
+import os
+import json
+import tempfile
+import os.path as opath
+
+
+# bump whenever the layout of the index file changes
+VERSION = 1
+
+
+def folder_mtimes(directories):
+    """Get the modification times of folders.
+
+    :param directories: iterable of path strings
+    :return: list of mtime_ns, or None if any of the folders is missing
+    """
+    try:
+        return [os.stat(d).st_mtime_ns for d in directories]
+    except FileNotFoundError:
+        return None
+
+
+class ScanIndex:
+    """The scan results of a data folder, keyed by patient.
+
+    usage:
+    index = ScanIndex('/path/to/index.json', '/path/to/data/folder')
+    rows = index.lookup(ids, directories, mtimes)
+    if rows is None:
+        rows = scan(directories)
+        index.store(ids, mtimes, rows)
+    index.save(id_list)
+    """
+
+    def __init__(self, index_file, root):
+        """Load the index file if it exists and belongs to the data folder.
+
+        :param index_file: path string to the index file
+        :param root: path string to the data folder
+        """
+        self.index_file = index_file
+        self.root = opath.abspath(root)
+        # (patient_id, original_id) -> (mtimes, rows of file names)
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(index_file, encoding='utf-8') as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return
+        if content.get('version') != VERSION or\
+           content.get('root') != self.root:
+            return
+        for pid, oid, mtimes, rows in content['patients']:
+            self.entries[(pid, oid)] = (mtimes, rows)
+
+    def lookup(self, ids, directories, mtimes):
+        """Get the rows of a patient if its folders did not change.
+
+        :param ids: 2-tuple of patient ID and original ID
+        :param directories: 3-tuple of the DICOM, i-contour and o-contour
+                            folder paths
+        :param mtimes: current modification times of the folders
+        :return: list of rows as returned by
+                 DicomContourParser._get_valid_sids, or None if the entry is
+                 missing or stale
+        """
+        entry = self.entries.get(ids)
+        if entry is None or entry[0] != mtimes:
+            return None
+        return [(sid,) + tuple(opath.join(d, name) if name else ''
+                               for d, name in zip(directories, names))
+                for sid, *names in entry[1]]
+
+    def store(self, ids, mtimes, rows):
+        """Record the rows of a patient.
+
+        :param ids: 2-tuple of patient ID and original ID
+        :param mtimes: modification times of the folders before the scan
+        :param rows: list of rows as returned by
+                     DicomContourParser._get_valid_sids
+        """
+        # only the file names are kept, the folders follow from the ids
+        self.entries[ids] = (mtimes, [
+            [sid] + [opath.basename(f) for f in filenames]
+            for sid, *filenames in rows])
+        self.dirty = True
+
+    def save(self, id_list):
+        """Write the index file if anything changed.
+
+        :param id_list: list of (patient ID, original ID) pairs currently in
+                        link.csv; entries of other pairs are dropped
+        """
+        ids = [i for i in id_list if i in self.entries]
+        if not self.dirty and len(ids) == len(self.entries):
+            return
+        content = {'version': VERSION, 'root': self.root, 'patients': [
+            [pid, oid] + list(self.entries[(pid, oid)]) for pid, oid in ids]}
+        directory = opath.dirname(opath.abspath(self.index_file))
+        os.makedirs(directory, exist_ok=True)
+        # write to a temporary file first, so that a concurrent reader never
+        # sees a partial index
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(content, f)
+            os.replace(tmp_path, self.index_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.dirty = False
@@ -0,0 +1,161 @@
+"""shared_slots.py
+
+This module provides a ring of shared memory slots that worker processes can
+write parsed arrays into, so that the parent process receives NumPy views over
+the shared memory instead of unpickling copies of the pixel data.
+
+"""
+
+from threading import Condition
+from collections import deque
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+# 512x512 float64 image plus two 512x512 boolean masks, with room for padding
+DEFAULT_SLOT_BYTES = 512 * 512 * (8 + 1 + 1) + 4096
+ALIGNMENT = 64
+
+# shared memory blocks attached by the current (worker) process, by name
+_attached = {}
+
+
+def _align(offset):
+    """Round offset up to the next multiple of ALIGNMENT
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _attach(name):
+    """Attach to a shared memory block by name, reusing earlier attachments.
+
+    :param name: name of the shared memory block
+    :return: a SharedMemory object
+    """
+    shm = _attached.get(name)
+    if shm is None:
+        shm = SharedMemory(name=name)
+        _attached[name] = shm
+    return shm
+
+
+def write_to_slot(func, args, slot_name):
+    """Run func(args) and write the arrays in its result into a slot.
+
+    This is meant to run in a worker process. Every ndarray field of the
+    result is copied into the slot, every other field is returned as is. If
+    the arrays do not fit into the slot, the result itself is returned and the
+    parent receives a pickled copy instead.
+
+    :param func: a picklable callable returning a tuple
+    :param args: the argument to call func with
+    :param slot_name: name of the shared memory block of the slot
+    :return: a layout list for read_slot, or the result of func
+    """
+    result = func(args)
+    shm = _attach(slot_name)
+    layout = []
+    offset = 0
+    for value in result:
+        if isinstance(value, np.ndarray):
+            offset = _align(offset)
+            end = offset + value.nbytes
+            if end > shm.size:
+                return result
+            view = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf,
+                              offset=offset)
+            view[...] = value
+            layout.append(('array', offset, value.shape, value.dtype.str))
+            offset = end
+        else:
+            layout.append(('value', value))
+    return layout
+
+
+class SlotRing:
+    """A growing number of equally sized shared memory slots.
+
+    Slots are handed out with acquire and given back with release. Arrays read
+    from a slot are views over the shared memory, so they are overwritten once
+    the slot is released and acquired again. The ring grows when all of its
+    slots are taken and never shrinks, since workers may still be writing
+    into any of its blocks until close.
+    """
+
+    def __init__(self, num_slots, slot_bytes=DEFAULT_SLOT_BYTES):
+        """Allocate num_slots shared memory blocks of slot_bytes each.
+
+        :param num_slots: initial number of slots in the ring
+        :param slot_bytes: size of each slot in bytes
+        """
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        self.blocks = [SharedMemory(create=True, size=slot_bytes)
+                       for _ in range(num_slots)]
+        self.names = [shm.name for shm in self.blocks]
+        self._free = deque(range(num_slots))
+        self._cond = Condition()
+
+    def acquire(self):
+        """Take a free slot, adding one to the ring if none is free.
+
+        :return: index of the slot
+        """
+        with self._cond:
+            if self._free:
+                return self._free.popleft()
+            shm = SharedMemory(create=True, size=self.slot_bytes)
+            self.blocks.append(shm)
+            self.names.append(shm.name)
+            self.num_slots = len(self.blocks)
+            return self.num_slots - 1
+
+    def release(self, index):
+        """Give a slot back to the ring; ignored once the ring is closed.
+
+        :param index: index of the slot
+        """
+        with self._cond:
+            if index >= len(self.blocks):
+                return
+            self._free.append(index)
+            self._cond.notify()
+
+    def read_slot(self, index, layout):
+        """Rebuild the values written by write_to_slot.
+
+        :param index: index of the slot
+        :param layout: the layout list returned by write_to_slot
+        :return: list of values, with ndarray views over the slot in place of
+                 the arrays
+        """
+        buf = self.blocks[index].buf
+        values = []
+        for item in layout:
+            if item[0] == 'array':
+                _, offset, shape, dtype = item
+                values.append(np.ndarray(shape, dtype=np.dtype(dtype),
+                                         buffer=buf, offset=offset))
+            else:
+                values.append(item[1])
+        return values
+
+    def close(self):
+        """Release the shared memory blocks.
+
+        Blocks still referenced by views stay mapped until the views are
+        garbage collected.
+        """
+        for shm in self.blocks:
+            try:
+                shm.close()
+            except BufferError:
+                # views over the block are still alive
+                pass
+            shm.unlink()
+        with self._cond:
+            self.blocks = []
+            self.names = []
+            self._free.clear()
+            self.num_slots = 0
@@ -0,0 +1,75 @@
+"""test_cache.py
+
+Test the dicom_contour_parser.cache module.
+
+"""
+
+
+import os
+import unittest
+import tempfile
+import numpy as np
+from dicom_contour_parser import DicomContourParser, RecordData
+from dicom_contour_parser.cache import SliceCache
+
+
+class test_cache(unittest.TestCase):
+    """Test the correctness of the SliceCache class
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmpdir.name, 'source.txt')
+        with open(self.source, 'w') as fp:
+            fp.write('source')
+        self.filenames = (self.source, '', '')
+        self.data = RecordData(
+            np.arange(12, dtype=np.int16).reshape(3, 4),
+            np.eye(3, 4, dtype=np.bool_), np.zeros((3, 4), dtype=np.bool_),
+            np.array([[1.0, 2.0], [3.0, 4.0]]), np.zeros((0, 2)))
+        self.cache = SliceCache(os.path.join(self.tmpdir.name, 'cache'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        """A cached entry should read back the same values
+        """
+        self.assertIsNone(self.cache.get(self.filenames))
+        self.cache.put(self.filenames, self.data)
+        data = RecordData(**self.cache.get(self.filenames))
+        for name in RecordData._fields:
+            np.testing.assert_array_equal(getattr(data, name),
+                                          getattr(self.data, name))
+            self.assertEqual(getattr(data, name).dtype,
+                             getattr(self.data, name).dtype)
+
+    def test_stale_entry(self):
+        """Changing a source file should invalidate its entry
+        """
+        self.cache.put(self.filenames, self.data)
+        st = os.stat(self.source)
+        os.utime(self.source, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertIsNone(self.cache.get(self.filenames))
+        self.assertEqual(len(self.cache.entries()), 1)
+        self.assertEqual(self.cache.prune(), 1)
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_parser_cache(self):
+        """A parser with a cache should produce the same results
+        """
+        test_folder = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), '../final_data/')
+        parser = DicomContourParser(test_folder)
+        records = parser.record_list[:50]
+        expected = [r.data for r in records]
+        cache_dir = os.path.join(self.tmpdir.name, 'parser_cache')
+        for _ in range(2):
+            # the first pass fills the cache, the second reads from it
+            p_cache = DicomContourParser(test_folder, cache_dir=cache_dir)
+            for r, e in zip(p_cache.record_list[:50], expected):
+                np.testing.assert_allclose(r.data.dicom, e.dicom)
+                np.testing.assert_array_equal(r.data.ic_mask, e.ic_mask)
+                np.testing.assert_array_equal(r.data.oc_mask, e.oc_mask)
+                np.testing.assert_array_equal(r.data.ic_path, e.ic_path)
+        self.assertEqual(len(p_cache.cache.entries()), 50)
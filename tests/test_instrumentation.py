@@ -0,0 +1,80 @@
+"""test_instrumentation.py
+
+Test the dicom_contour_parser.instrumentation module.
+
+"""
+
+
+import os
+import unittest
+from dicom_contour_parser import DicomContourParser, instrumentation
+from dicom_contour_parser.instrumentation import Histogram, Stats
+
+
+class test_instrumentation(unittest.TestCase):
+    """Test the correctness of the Stats class and the pipeline stages
+    """
+
+    def setUp(self):
+        self.TEST_FOLDER = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), '../final_data/')
+
+    def tearDown(self):
+        instrumentation.disable()
+
+    def test_histogram(self):
+        """Percentiles should be bucket bounds capped by the maximum
+        """
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), 0.0)
+        for _ in range(90):
+            histogram.add(3e-6, 10)
+        for _ in range(10):
+            histogram.add(0.5)
+        self.assertEqual(histogram.percentile(50), 4e-6)
+        self.assertEqual(histogram.percentile(99), 0.5)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['bytes'], 900)
+        self.assertAlmostEqual(summary['total'], 5.00027)
+
+    def test_pipeline_stages(self):
+        """An epoch should record every stage of every record, and hooks
+        should see every measurement
+        """
+        stats = instrumentation.enable()
+        seen = []
+        stats.add_hook(lambda stage, seconds, nbytes: seen.append(stage))
+        parser = DicomContourParser(self.TEST_FOLDER,
+                                    max_cache_bytes=10 ** 10)
+        num_batches = 0
+        for _ in parser.random_shuffled_iterator(100):
+            num_batches += 1
+        for record in parser.record_list[:10]:
+            record.data
+        summary = stats.summary()
+        self.assertEqual(summary['scan']['count'], 1)
+        self.assertEqual(summary['scan_patient']['count'],
+                         len(parser.id_list))
+        self.assertEqual(summary['load_record']['count'], 1140)
+        self.assertEqual(summary['read_dicom']['count'], 1140)
+        self.assertGreater(summary['read_dicom']['bytes'], 0)
+        self.assertEqual(summary['read_contour']['count'], 225 + 110)
+        self.assertEqual(summary['rasterize']['count'], 225 + 110)
+        self.assertEqual(summary['stall']['count'], num_batches)
+        self.assertEqual(summary['counters']['memory_hit'], 10)
+        self.assertEqual(len(seen), sum(s['count'] for name, s
+                                        in summary.items()
+                                        if name != 'counters'))
+        self.assertIn('read_dicom', stats.report())
+
+    def test_disabled(self):
+        """Nothing should be recorded while disabled
+        """
+        stats = Stats()
+        instrumentation.enable(stats)
+        self.assertIs(instrumentation.disable(), stats)
+        for _ in DicomContourParser(self.TEST_FOLDER)\
+                .random_shuffled_iterator(300):
+            pass
+        self.assertEqual(stats.summary(), {'counters': {}})
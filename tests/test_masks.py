@@ -0,0 +1,44 @@
+"""test_masks.py
+
+Test the dicom_contour_parser.masks module.
+
+"""
+
+
+import pickle
+import unittest
+import numpy as np
+from dicom_contour_parser.masks import PackedMask, empty_mask
+
+
+class test_masks(unittest.TestCase):
+    """Test the correctness of the PackedMask class
+    """
+
+    def test_round_trip(self):
+        """Packed masks should unpack to the same values
+        """
+        mask = np.random.RandomState(0).rand(13, 21) > 0.5
+        packed = PackedMask.pack(mask)
+        self.assertEqual(packed.shape, (13, 21))
+        self.assertEqual(packed.nbytes, (13 * 21 + 7) // 8)
+        np.testing.assert_array_equal(packed.unpack(), mask)
+        np.testing.assert_array_equal(np.asarray(packed), mask)
+        out = np.ones((2, 15, 25), dtype=np.bool_)
+        packed.unpack_into(out[1, :13, :21])
+        np.testing.assert_array_equal(out[1, :13, :21], mask)
+        self.assertTrue(out[0].all() and out[1, 13:].all())
+        self.assertEqual(pickle.loads(pickle.dumps(packed)), packed)
+
+    def test_empty_sentinel(self):
+        """Empty masks of one shape should be one shared object
+        """
+        empty = PackedMask.pack(np.zeros((8, 9), dtype=np.bool_))
+        self.assertIs(empty, empty_mask((8, 9)))
+        self.assertIsNot(empty, empty_mask((9, 8)))
+        self.assertEqual(empty.nbytes, 0)
+        self.assertFalse(empty.any())
+        self.assertIs(pickle.loads(pickle.dumps(empty)), empty)
+        out = np.ones((8, 9), dtype=np.bool_)
+        empty.unpack_into(out)
+        self.assertFalse(out.any())
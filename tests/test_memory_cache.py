@@ -0,0 +1,74 @@
+"""test_memory_cache.py
+
+Test the dicom_contour_parser.memory_cache module.
+
+"""
+
+
+import os
+import unittest
+import numpy as np
+from dicom_contour_parser import DicomContourParser
+from dicom_contour_parser.memory_cache import MemoryCache
+
+
+class test_memory_cache(unittest.TestCase):
+    """Test the correctness of the MemoryCache class
+    """
+
+    def setUp(self):
+        self.TEST_FOLDER = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), '../final_data/')
+
+    def test_lru_order(self):
+        """The least recently used rows should be evicted first
+        """
+        memory = MemoryCache(300)
+        self.assertEqual(memory.add(0, 100), [])
+        self.assertEqual(memory.add(1, 100), [])
+        self.assertEqual(memory.add(2, 100), [])
+        self.assertTrue(memory.hit(0))
+        self.assertFalse(memory.hit(3))
+        self.assertEqual(memory.add(3, 150), [1, 2])
+        self.assertEqual(memory.add(4, 400), [0, 3, 4])
+        self.assertEqual(memory.stats(), (1, 5, 5, 0, 300))
+
+    def test_keep(self):
+        """Rows to keep should be skipped by the eviction
+        """
+        memory = MemoryCache(300)
+        for i in range(3):
+            memory.add(i, 100)
+        self.assertEqual(memory.add(3, 100, keep=lambda i: i == 0), [1])
+        self.assertEqual(memory.add(4, 300, keep=lambda i: i != 2), [2])
+        self.assertEqual(memory.nbytes, 500)
+        # once the kept rows are released
+        self.assertEqual(memory.evict(keep=lambda i: i == 4), [0, 3])
+        self.assertEqual(memory.nbytes, 300)
+
+    def test_parser_budget(self):
+        """Loaded records should stay within the budget and stay resident
+        """
+        parser = DicomContourParser(self.TEST_FOLDER,
+                                    max_cache_bytes=20 * 256 * 256 * 4)
+        record = parser.record_list[0]
+        data = record.data
+        self.assertIs(record.data, data)
+        self.assertEqual(parser.memory_cache.stats()[:2], (1, 1))
+        count = 0
+        for batch in parser.random_shuffled_iterator(8):
+            for item in batch:
+                self.assertEqual(type(item.dicom), np.ndarray)
+                count += 1
+            resident = [d for d in parser.table.data if d is not None]
+            self.assertLessEqual(sum(d.dicom.nbytes + d.ic_mask.nbytes +
+                                     d.oc_mask.nbytes for d in resident),
+                                 parser.memory_cache.max_bytes)
+        self.assertEqual(count, 1140)
+        stats = parser.memory_cache.stats()
+        self.assertGreater(stats.evictions, 0)
+        self.assertEqual(stats.nbytes, sum(
+            d.dicom.nbytes + d.ic_mask.nbytes + d.oc_mask.nbytes +
+            d.ic_path.nbytes + d.oc_path.nbytes
+            for d in parser.table.data if d is not None))
+        self.assertGreater(len(parser.memory_cache), 0)
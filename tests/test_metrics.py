@@ -0,0 +1,97 @@
+"""test_metrics.py
+
+Test the dicom_contour_parser.metrics module.
+
+"""
+
+
+import os
+import unittest
+import numpy as np
+from dicom_contour_parser import DicomContourParser
+from dicom_contour_parser.metrics import (IntensityROC, confusion_counts,
+                                          dice)
+
+
+class test_metrics(unittest.TestCase):
+    """Test the correctness of the batch metrics
+    """
+
+    def setUp(self):
+        self.TEST_FOLDER = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), '../final_data/')
+
+    def test_confusion_counts(self):
+        """Batch counts and Dice should match per-mask loops
+        """
+        rng = np.random.RandomState(0)
+        predicted = rng.rand(6, 20, 30) > 0.5
+        truth = rng.rand(6, 20, 30) > 0.3
+        region = rng.rand(6, 20, 30) > 0.2
+        predicted[5] = truth[5] = False
+        counts = confusion_counts(predicted, truth, region)
+        scores = dice(predicted, truth, region)
+        for k in range(6):
+            p, t, r = predicted[k] & region[k], truth[k] & region[k], region[k]
+            self.assertEqual(counts.true_pos[k], np.sum(p & t))
+            self.assertEqual(counts.false_pos[k], np.sum(p & ~t))
+            self.assertEqual(counts.false_neg[k], np.sum(~p & t))
+            self.assertEqual(counts.true_neg[k], np.sum(r & ~p & ~t))
+            if k < 5:
+                self.assertAlmostEqual(
+                    scores[k], 2 * np.sum(p & t) / (np.sum(p) + np.sum(t)))
+        self.assertEqual(scores[5], 1.0)
+        single = confusion_counts(predicted[0], truth[0])
+        self.assertEqual(single.true_neg[0], np.sum(~predicted[0] & ~truth[0]))
+
+    def test_intensity_roc(self):
+        """The streamed ROC should match the sorted two-pointer walk
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+        roc = IntensityROC()
+        stacked_roc = IntensityROC()
+        blood, muscle = [], []
+        for chunk in parser.balanced_iterator(
+                20, positive='both', positive_fraction=1.0, num_batches=3,
+                seed=0):
+            roc.update(chunk)
+            for data in chunk:
+                blood.extend(data.dicom[data.ic_mask])
+                muscle.extend(data.dicom[data.oc_mask & ~data.ic_mask])
+        for batch in parser.balanced_iterator(
+                20, positive='both', positive_fraction=1.0, num_batches=3,
+                seed=0, stacked=True):
+            stacked_roc.update(batch)
+        np.testing.assert_array_equal(roc.blood, stacked_roc.blood)
+        np.testing.assert_array_equal(roc.muscle, stacked_roc.muscle)
+        batch = next(parser.random_shuffled_iterator(5, stacked=True,
+                                                     fields='dicom'))
+        with self.assertRaises(ValueError):
+            stacked_roc.update(batch)
+        self.assertEqual(roc.blood.sum(), len(blood))
+        blood.sort()
+        muscle.sort()
+        curve = roc.curve()
+        false_pos, false_neg = len(muscle), 0
+        for v in muscle:
+            false_pos -= 1
+            while false_neg < len(blood) and blood[false_neg] <= v:
+                false_neg += 1
+            # integer pixel values: "above v" is "at or above v + 1"
+            k = int(v) + 1
+            if false_pos and muscle[len(muscle) - false_pos] == v:
+                continue
+            self.assertAlmostEqual(curve.tpr[k], 1 - false_neg / len(blood))
+            self.assertAlmostEqual(curve.fpr[k], false_pos / len(muscle))
+        self.assertEqual((curve.tpr[0], curve.fpr[0]), (1.0, 1.0))
+        self.assertEqual((curve.tpr[-1], curve.fpr[-1]), (0.0, 0.0))
+        self.assertTrue(0 <= roc.auc() <= 1)
+        # perfectly separated regions
+        toy = IntensityROC(bins=10, value_range=(0, 100))
+        image = np.array([[5, 15, 80], [95, 200, -3]])
+        ic = np.array([[0, 0, 1], [1, 1, 0]], dtype=np.bool_)
+        toy.update_arrays(image, ic, np.ones_like(ic))
+        np.testing.assert_array_equal(toy.blood, [0] * 8 + [1, 2])
+        np.testing.assert_array_equal(toy.muscle, [2, 1] + [0] * 8)
+        self.assertEqual(toy.auc(), 1.0)
+        self.assertEqual(toy.best_threshold(), 20.0)
@@ -0,0 +1,114 @@
+"""test_packed.py
+
+Test the dicom_contour_parser.packed module.
+
+"""
+
+
+import os
+import unittest
+import tempfile
+import numpy as np
+from dicom_contour_parser import (DicomContourParser, PackedDataset,
+                                  compile_dataset)
+
+
+class test_packed(unittest.TestCase):
+    """Test the correctness of compile_dataset and PackedDataset
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.TEST_FOLDER = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), '../final_data/')
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.packed_file = os.path.join(cls.tmpdir.name, 'data.pack')
+        compile_dataset(DicomContourParser(cls.TEST_FOLDER), cls.packed_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_compact_masks(self):
+        """Compact masks should be served from the packed bits
+        """
+        dataset = PackedDataset(self.packed_file)
+        compact = PackedDataset(self.packed_file, compact_masks=True)
+        for r, c in zip(dataset.record_list, compact.record_list):
+            mask = c.data.oc_mask
+            if mask.any():
+                self.assertTrue(np.shares_memory(mask.bits, compact.mm))
+            np.testing.assert_array_equal(mask, r.data.oc_mask)
+
+    def test_fields(self):
+        """Only the selected fields should be read from the packed file
+        """
+        dataset = PackedDataset(self.packed_file)
+        for chunk in dataset.random_shuffled_iterator(200,
+                                                      fields='ic_path'):
+            for data in chunk:
+                self.assertIsNone(data.dicom)
+                self.assertIsNone(data.ic_mask)
+                self.assertIsNotNone(data.ic_path)
+
+    def test_same_records(self):
+        """Packed records should match the parsed ones
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+        dataset = PackedDataset(self.packed_file)
+        self.assertEqual(len(parser.record_list), len(dataset.record_list))
+        for r, p in zip(parser.record_list, dataset.record_list):
+            self.assertEqual((r.patient_id, r.original_id, r.serial_id),
+                             (p.patient_id, p.original_id, p.serial_id))
+            self.assertEqual(r.has_dicom(), p.has_dicom())
+            self.assertEqual(r.has_icontour(), p.has_icontour())
+            self.assertEqual(r.has_ocontour(), p.has_ocontour())
+            np.testing.assert_array_equal(r.data.dicom, p.data.dicom)
+            self.assertEqual(r.data.dicom.dtype, p.data.dicom.dtype)
+            np.testing.assert_array_equal(r.data.ic_mask, p.data.ic_mask)
+            np.testing.assert_array_equal(r.data.oc_mask, p.data.oc_mask)
+            np.testing.assert_array_equal(r.data.ic_path, p.data.ic_path)
+            np.testing.assert_array_equal(r.data.oc_path, p.data.oc_path)
+            r.clear_data()
+            p.clear_data()
+
+    def test_one_epoch(self):
+        """The packed iterator should yield every record once
+        """
+        dataset = PackedDataset(self.packed_file, async_load=True)
+        keys = []
+        for chunk in dataset.random_shuffled_iterator(100, tag_records=True):
+            keys.extend(key for key, _ in chunk)
+            for _, item in chunk:
+                self.assertEqual(type(item.dicom), np.ndarray)
+        self.assertEqual(len(keys), len(dataset.record_list))
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_shapes(self):
+        """Packed shapes should match the shapes read from the headers
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+        dataset = PackedDataset(self.packed_file)
+        np.testing.assert_array_equal(parser.table.shapes(),
+                                      dataset.table.shapes())
+        for name in ('valid', 'rows', 'cols', 'dtype', 'slice_location'):
+            np.testing.assert_array_equal(parser.table.metadata()[name],
+                                          dataset.table.metadata()[name])
+        for (ids, rows), (packed_ids, packed_rows) in zip(
+                parser.patient_rows('position'),
+                dataset.patient_rows('position')):
+            self.assertEqual(ids, packed_ids)
+            np.testing.assert_array_equal(rows, packed_rows)
+        np.testing.assert_array_equal(parser.table.estimated_nbytes(),
+                                      dataset.table.estimated_nbytes())
+        count = 0
+        for batch in dataset.shape_bucketed_iterator(100, stacked=True):
+            self.assertTrue(np.all(batch.shapes == batch.shapes[0]))
+            count += len(batch)
+        self.assertEqual(count, len(dataset.record_list))
+
+    def test_process_loader(self):
+        """The process loader is not supported on packed files
+        """
+        with self.assertRaises(ValueError):
+            PackedDataset(self.packed_file, loader='process')
@@ -8,6 +8,8 @@ import unittest
 import tempfile
 import numpy as np
 from dicom_contour_parser import DicomContourParser, InvalidDataFolder, Record
+from dicom_contour_parser import NOT_LOADED, LOADING, LOADED, EVICTED
+from dicom_contour_parser import field_mask
 
 
 class test_record(unittest.TestCase):
@@ -155,6 +157,573 @@ class test_parser(unittest.TestCase):
             np.testing.assert_allclose(e_sync[0], e_async[0])
             np.testing.assert_allclose(e_sync[1], e_async[1])
 
+    def test_process_loader_correctness(self):
+        """Process loader should produce the same results as sync loader.
+        """
+        p_sync = DicomContourParser(self.TEST_FOLDER, loader='sync')
+        d_sync = []
+        for chunk in p_sync.random_shuffled_iterator(100, tag_records=True):
+            d_sync.extend(chunk)
+        with DicomContourParser(self.TEST_FOLDER, loader='process',
+                                num_workers=2) as p_proc:
+            d_proc = []
+            for chunk in p_proc.random_shuffled_iterator(100,
+                                                         tag_records=True):
+                d_proc.extend(chunk)
+        self.assertEqual(len(d_sync), len(d_proc))
+        d_sync.sort(key=lambda e: e[0])
+        d_proc.sort(key=lambda e: e[0])
+        for (k_sync, e_sync), (k_proc, e_proc) in zip(d_sync, d_proc):
+            self.assertEqual(k_sync, k_proc)
+            np.testing.assert_allclose(e_sync.dicom, e_proc.dicom)
+            np.testing.assert_array_equal(e_sync.ic_mask, e_proc.ic_mask)
+            np.testing.assert_array_equal(e_sync.oc_mask, e_proc.oc_mask)
+
+    def test_shared_memory_correctness(self):
+        """Shared memory transport should produce the same results.
+        """
+        p_sync = DicomContourParser(self.TEST_FOLDER, loader='sync')
+        d_sync = {}
+        for chunk in p_sync.random_shuffled_iterator(100, tag_records=True):
+            d_sync.update(chunk)
+        # a tiny slot size forces the pickling fallback
+        for slot_bytes in (None, 1024):
+            kwargs = {} if slot_bytes is None else {'slot_bytes': slot_bytes}
+            with DicomContourParser(self.TEST_FOLDER, loader='process',
+                                    num_workers=2, shared_memory=True,
+                                    **kwargs) as p_shm:
+                count = 0
+                for chunk in p_shm.random_shuffled_iterator(
+                        100, tag_records=True):
+                    # views are only valid until the next batch
+                    for key, item in chunk:
+                        expected = d_sync[key]
+                        np.testing.assert_allclose(item.dicom,
+                                                   expected.dicom)
+                        np.testing.assert_array_equal(item.ic_mask,
+                                                      expected.ic_mask)
+                        np.testing.assert_array_equal(item.oc_mask,
+                                                      expected.oc_mask)
+                        count += 1
+                self.assertEqual(count, len(d_sync))
+        # iterators running at the same time share the slots
+        with DicomContourParser(self.TEST_FOLDER, loader='process',
+                                num_workers=2, shared_memory=True,
+                                prefetch_depth=2) as p_shm:
+            iterators = [p_shm.random_shuffled_iterator(
+                size, tag_records=True, seed=size) for size in (10, 20)]
+            counts = [0, 0]
+            while iterators:
+                chunks = []
+                for iterator in list(iterators):
+                    chunk = next(iterator, None)
+                    if chunk is None:
+                        iterators.remove(iterator)
+                    else:
+                        chunks.append(chunk)
+                # a batch stays valid while the other iterator moves on
+                for chunk in chunks:
+                    for key, item in chunk:
+                        np.testing.assert_allclose(item.dicom,
+                                                   d_sync[key].dicom)
+                    counts[len(chunk) > 10] += len(chunk)
+            self.assertEqual(counts, [len(d_sync), len(d_sync)])
+            ring = p_shm.slot_ring
+            self.assertEqual(len(ring._free), ring.num_slots)
+
+    def test_prefetch_depth(self):
+        """A deep prefetch queue should produce every record once and clean
+        up after an early stop.
+        """
+        with DicomContourParser(self.TEST_FOLDER, loader='thread',
+                                num_workers=3, prefetch_depth=4) as parser:
+            tags = []
+            for chunk in parser.random_shuffled_iterator(50,
+                                                         tag_records=True):
+                self.assertTrue(all(type(item.dicom) == np.ndarray
+                                    for _, item in chunk))
+                tags.extend(key for key, _ in chunk)
+            self.assertEqual(len(tags), 1140)
+            self.assertEqual(len(set(tags)), 1140)
+            self.assertTrue(all(d is None for d in parser.table.data))
+        with DicomContourParser(self.TEST_FOLDER, loader='process',
+                                num_workers=2, shared_memory=True,
+                                prefetch_depth=3) as parser:
+            iterator = parser.random_shuffled_iterator(10)
+            next(iterator)
+            iterator.close()
+            ring = parser.slot_ring
+            self.assertEqual(len(ring._free), ring.num_slots)
+            # an iterator outliving its parser
+            iterator = parser.random_shuffled_iterator(10)
+            next(iterator)
+        iterator.close()
+        self.assertFalse((parser.table.slot >= 0).any())
+        with parser:
+            count = sum(len(chunk) for chunk in
+                        parser.random_shuffled_iterator(100))
+            self.assertEqual(count, 1140)
+            ring = parser.slot_ring
+            self.assertEqual(len(ring._free), ring.num_slots)
+
+    def test_stacked_batches(self):
+        """Stacked batches should hold the padded records and reuse their
+        arrays
+        """
+        p_sync = DicomContourParser(self.TEST_FOLDER)
+        expected = {}
+        for chunk in p_sync.random_shuffled_iterator(100, tag_records=True):
+            expected.update(chunk)
+        parser = DicomContourParser(self.TEST_FOLDER, async_load=True)
+        count = 0
+        storage = None
+        for batch in parser.random_shuffled_iterator(64, tag_records=True,
+                                                     stacked=True):
+            self.assertEqual(batch.images.shape[0], len(batch))
+            self.assertEqual(batch.images.shape, batch.ic_masks.shape)
+            self.assertTrue(batch.images.flags.c_contiguous)
+            for k, tag in enumerate(batch.tags):
+                data = expected[tag]
+                rows, cols = batch.shapes[k]
+                self.assertEqual((rows, cols), data.dicom.shape)
+                np.testing.assert_array_equal(batch.images[k, :rows, :cols],
+                                              data.dicom)
+                np.testing.assert_array_equal(
+                    batch.oc_masks[k, :rows, :cols], data.oc_mask)
+                self.assertEqual(batch.images[k, rows:].sum(), 0)
+                self.assertFalse(batch.ic_masks[k, :, cols:].any())
+                count += 1
+            if storage is not None and len(batch) == 64:
+                self.assertTrue(np.shares_memory(batch.images, storage))
+            storage = batch.images
+        self.assertEqual(count, 1140)
+
+    def test_shape_bucketed_iterator(self):
+        """Every batch should hold records of one shape, and every record
+        should be yielded once
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+        shapes = parser.table.shapes()
+        self.assertEqual(tuple(shapes[0]),
+                         parser.record_list[0].data.dicom.shape)
+        indices = []
+        for batch in parser.shape_bucketed_iterator(64, stacked=True):
+            self.assertTrue(np.all(batch.shapes == batch.shapes[0]))
+            self.assertEqual(batch.images.shape[1:], tuple(batch.shapes[0]))
+            indices.extend(batch.indices)
+        self.assertEqual(sorted(indices), list(range(1140)))
+
+    def test_metadata(self):
+        """The metadata column should describe the loaded images
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+        meta = parser.table.metadata()
+        self.assertEqual(len(meta), 1140)
+        nbytes = parser.table.estimated_nbytes()
+        for i in range(0, 1140, 97):
+            record = parser.record_list[i]
+            data = record.data
+            self.assertEqual(record.metadata['valid'], record.has_dicom())
+            self.assertEqual((record.metadata['rows'],
+                              record.metadata['cols']), data.dicom.shape)
+            self.assertEqual(np.dtype(meta['dtype'][i]), data.dicom.dtype)
+            self.assertEqual(nbytes[i], data.dicom.nbytes +
+                             data.ic_mask.nbytes + data.oc_mask.nbytes)
+            record.clear_data()
+
+    def test_balanced_iterator(self):
+        """Balanced batches should hold the requested share of positives and
+        only load the drawn records
+        """
+        parser = DicomContourParser(self.TEST_FOLDER,
+                                    max_cache_bytes=10 ** 10)
+        positive, negative = parser.positive_indices('icontour')
+        self.assertEqual(len(positive) + len(negative), 1140)
+        num_drawn = 0
+        for batch in parser.balanced_iterator(10, 0.4, num_batches=3,
+                                              stacked=True):
+            self.assertEqual(len(batch), 10)
+            has_icontour = [parser.record_list[i].has_icontour()
+                            for i in batch.indices]
+            self.assertEqual(sum(has_icontour), 4)
+            self.assertEqual(batch.ic_masks.any(axis=(1, 2)).tolist(),
+                             has_icontour)
+            num_drawn += len(set(batch.indices))
+        self.assertEqual(parser.memory_cache.stats().misses, num_drawn)
+        with self.assertRaises(ValueError):
+            parser.positive_indices('lv')
+
+    def test_seeded_iterator(self):
+        """A seed and an epoch number should fix the order
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+
+        def tags(seed, epoch):
+            return [key for chunk in parser.random_shuffled_iterator(
+                        200, tag_records=True, seed=seed, epoch=epoch)
+                    for key, _ in chunk]
+        self.assertEqual(tags(7, 0), tags(7, 0))
+        self.assertNotEqual(tags(7, 0), tags(7, 1))
+        self.assertNotEqual(tags(7, 0), tags(8, 0))
+
+    def test_resume_epoch_iterator(self):
+        """A restored iterator should continue at the same batch without
+        loading the batches before it
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+        epochs = parser.epoch_iterator(100, seed=3, stacked=True)
+        self.assertEqual(len(epochs), 12)
+        first = [batch.indices.copy() for batch in epochs]
+        self.assertEqual(epochs.get_state()['epoch'], 1)
+        for k, batch in enumerate(epochs):
+            if k == 4:
+                state = epochs.get_state()
+                break
+        expected = [batch.indices.copy() for batch in epochs]
+        self.assertEqual(len(expected), 7)
+        self.assertEqual(epochs.get_state(),
+                         {'seed': 3, 'epoch': 2, 'batch': 0,
+                          'batch_size': 100})
+
+        resumed = DicomContourParser(self.TEST_FOLDER,
+                                     max_cache_bytes=10 ** 10)
+        epochs = resumed.epoch_iterator(100, stacked=True)
+        epochs.set_state(state)
+        rest = [batch.indices.copy() for batch in epochs]
+        self.assertEqual(len(rest), len(expected))
+        for a, b in zip(rest, expected):
+            np.testing.assert_array_equal(a, b)
+        self.assertEqual(resumed.memory_cache.stats().misses,
+                         sum(len(b) for b in expected))
+        self.assertFalse(np.array_equal(np.concatenate(first),
+                                        np.concatenate(epochs.batches(1))))
+        with self.assertRaises(ValueError):
+            resumed.epoch_iterator(50).set_state(state)
+
+    def test_sharded_iterator(self):
+        """Shards should be disjoint, have the same number of batches, and
+        only load their own records
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+        with self.assertRaises(ValueError):
+            parser.random_shuffled_iterator(10, num_shards=2)
+        with self.assertRaises(ValueError):
+            parser.epoch_iterator(10, num_shards=2, shard_index=1)
+        for balance in DicomContourParser.BALANCES:
+            shards = []
+            for k in range(3):
+                shards.append([
+                    key for chunk in parser.random_shuffled_iterator(
+                        100, tag_records=True, seed=5, num_shards=3,
+                        shard_index=k, balance=balance)
+                    for key, _ in chunk])
+            keys = [set(shard) for shard in shards]
+            self.assertEqual(len(keys[0] | keys[1] | keys[2]), 1140)
+            self.assertEqual(sum(len(k) for k in keys), 1140)
+            if balance == 'patient':
+                patients = [set(key.split(':')[0] for key in k) for k in keys]
+                self.assertFalse(patients[0] & patients[1] & patients[2])
+        counts = [len(parser.epoch_iterator(
+            100, seed=2, num_shards=3, shard_index=k, balance='patient'))
+            for k in range(3)]
+        self.assertEqual(len(set(counts)), 1)
+        # one patient per shard, and no shard without a patient
+        counts = [len(parser.epoch_iterator(
+            100, seed=2, num_shards=5, shard_index=k, balance='patient'))
+            for k in range(5)]
+        self.assertEqual(len(set(counts)), 1)
+        self.assertGreater(counts[0], 0)
+        with self.assertRaises(ValueError):
+            parser.epoch_iterator(100, seed=2, num_shards=8, shard_index=0,
+                                  balance='patient')
+        parser = DicomContourParser(self.TEST_FOLDER,
+                                    max_cache_bytes=10 ** 10)
+        records = set()
+        for batch in parser.shape_bucketed_iterator(
+                50, stacked=True, seed=5, num_shards=4, shard_index=1):
+            self.assertTrue(np.all(batch.shapes == batch.shapes[0]))
+            records.update(batch.indices)
+        self.assertEqual(parser.memory_cache.stats().misses, len(records))
+        self.assertLess(len(records), 1140 // 4 + 50)
+
+    def test_async_api(self):
+        """Concurrent aload calls should share one load, and the async
+        iterator should yield every record once
+        """
+        import asyncio
+        parser = DicomContourParser(self.TEST_FOLDER, num_workers=2,
+                                    max_cache_bytes=10 ** 10)
+        record = parser.record_list[7]
+
+        async def fetch():
+            return await asyncio.gather(*[record.aload() for _ in range(5)])
+        results = asyncio.run(fetch())
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(parser.memory_cache.stats().misses, 1)
+        np.testing.assert_array_equal(
+            results[0].dicom, DicomContourParser(self.TEST_FOLDER)
+            .record_list[7].data.dicom)
+
+        async def consume():
+            tags = []
+            async for chunk in parser.arandom_shuffled_iterator(
+                    100, tag_records=True, seed=1):
+                tags.extend(key for key, _ in chunk)
+            return tags
+        with parser:
+            tags = asyncio.run(consume())
+        self.assertEqual(len(tags), 1140)
+        self.assertEqual(len(set(tags)), 1140)
+        self.assertEqual(parser.memory_cache.stats().misses, 1140)
+        # event loops on several threads awaiting the same record
+        from concurrent.futures import ThreadPoolExecutor
+        for _ in range(5):
+            record.clear_data()
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                loads = list(pool.map(lambda _: asyncio.run(fetch()),
+                                      range(4)))
+            self.assertTrue(all(r[0] is loads[0][0] for r in loads))
+
+    def test_single_flight(self):
+        """Threads reading one record at once should share a single load
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        parser = DicomContourParser(self.TEST_FOLDER,
+                                    max_cache_bytes=10 ** 10)
+        record = parser.record_list[3]
+        self.assertEqual(record.state, NOT_LOADED)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda _: record.data, range(16)))
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(parser.memory_cache.stats().misses, 1)
+        self.assertEqual(record.state, LOADED)
+        # a row loading more fields stays loading when its data is dropped
+        table = parser.table
+        record = parser.record_list[5]
+        record.get_fields('ic_path')
+        self.assertTrue(table.claim(5, field_mask('dicom')))
+        table.clear(5)
+        self.assertEqual(record.state, LOADING)
+        table.abandon(5)
+        self.assertEqual(record.state, NOT_LOADED)
+        # and an abandoned load keeps the fields loaded before
+        record.get_fields('ic_path')
+        self.assertTrue(table.claim(5, field_mask('dicom')))
+        table.abandon(5)
+        self.assertEqual(record.state, LOADED)
+        self.assertIsNotNone(table.wait(5).ic_path)
+
+    def test_pinning(self):
+        """Pinned records should survive iterators and eviction
+        """
+        for options in ({}, {'max_cache_bytes': 5 * 256 * 256 * 4},
+                        {'async_load': True, 'loader': 'process',
+                         'num_workers': 2, 'shared_memory': True}):
+            with DicomContourParser(self.TEST_FOLDER, **options) as parser:
+                record = parser.record_list[0]
+                with record.pinned():
+                    data = record.data
+                    for _ in parser.random_shuffled_iterator(50, seed=2):
+                        pass
+                    self.assertIs(record._data, data)
+                    self.assertEqual(record.state, LOADED)
+                if not options:
+                    # the clear asked for while pinned happens on unpin
+                    self.assertIsNone(record._data)
+                    self.assertEqual(record.state, EVICTED)
+        # prefetched records stay until their batch is used, even when the
+        # cache holds fewer records than are prefetched
+        with DicomContourParser(self.TEST_FOLDER, async_load=True,
+                                loader='thread', prefetch_depth=3,
+                                max_cache_bytes=300000) as parser:
+            count = 0
+            for epoch in range(2):
+                for chunk in parser.random_shuffled_iterator(
+                        20, seed=1, epoch=epoch):
+                    count += len(chunk)
+            # each slice is loaded or found in the cache, never both;
+            # records left from epoch 0 may be hits of epoch 1
+            stats = parser.memory_cache.stats()
+            self.assertEqual(stats.hits + stats.misses, count)
+            self.assertFalse(parser.table.pins.any())
+            # and are evicted once unpinned
+            self.assertLessEqual(stats.nbytes, stats.max_bytes)
+
+    def test_lazy_fields(self):
+        """Fields should load independently and match a full load
+        """
+        full = DicomContourParser(self.TEST_FOLDER)
+        parser = DicomContourParser(self.TEST_FOLDER)
+        # records with both contours, only an i-contour, and none
+        for index in (np.nonzero(full.table.has_file(slice(None), 2))[0][0],
+                      np.nonzero(full.table.has_file(slice(None), 1))[0][-1],
+                      0):
+            expected = full.record_list[index].data
+            record = parser.record_list[index]
+            np.testing.assert_array_equal(record.ic_path, expected.ic_path)
+            self.assertIsNone(record._data.dicom)
+            self.assertIsNone(record._data.ic_mask)
+            np.testing.assert_array_equal(record.oc_mask, expected.oc_mask)
+            self.assertIsNone(record._data.dicom)
+            for name in expected._fields:
+                np.testing.assert_array_equal(getattr(record.data, name),
+                                              getattr(expected, name))
+        with self.assertRaises(ValueError):
+            parser.record_list[0].get_fields('pixels')
+
+    def test_fields_iterator(self):
+        """Iterators should only load the selected fields
+        """
+        for options in ({}, {'async_load': True, 'loader': 'thread'},
+                        {'async_load': True, 'loader': 'process',
+                         'num_workers': 2, 'shared_memory': True}):
+            with DicomContourParser(self.TEST_FOLDER, **options) as parser:
+                count = 0
+                for chunk in parser.random_shuffled_iterator(
+                        100, seed=3, fields=('ic_path', 'oc_path')):
+                    for data in chunk:
+                        self.assertIsNone(data.dicom)
+                        self.assertIsNone(data.ic_mask)
+                        self.assertEqual(data.ic_path.shape[1], 2)
+                        count += 1
+                self.assertEqual(count, 1140)
+                for batch in parser.random_shuffled_iterator(
+                        50, stacked=True, seed=3, fields='ic_mask'):
+                    self.assertIsNone(batch.images)
+                    self.assertIsNone(batch.ic_paths)
+                    self.assertEqual(batch.ic_masks.shape[0], len(batch))
+                    self.assertTrue(np.all(batch.shapes > 0))
+
+    def test_compact_masks(self):
+        """Compact masks should hold the same values in less memory
+        """
+        from dicom_contour_parser.masks import PackedMask
+        full = DicomContourParser(self.TEST_FOLDER, max_cache_bytes=10 ** 10)
+        expected = {}
+        for chunk in full.random_shuffled_iterator(100, tag_records=True):
+            expected.update(chunk)
+        for options in ({}, {'async_load': True, 'loader': 'process',
+                             'num_workers': 2}):
+            with DicomContourParser(self.TEST_FOLDER, compact_masks=True,
+                                    max_cache_bytes=10 ** 10,
+                                    **options) as parser:
+                for chunk in parser.random_shuffled_iterator(
+                        100, tag_records=True):
+                    for tag, data in chunk:
+                        self.assertIsInstance(data.ic_mask, PackedMask)
+                        np.testing.assert_array_equal(
+                            data.ic_mask, expected[tag].ic_mask)
+                        np.testing.assert_array_equal(
+                            data.oc_mask, expected[tag].oc_mask)
+                for batch in parser.random_shuffled_iterator(
+                        64, tag_records=True, stacked=True):
+                    for k, tag in enumerate(batch.tags):
+                        rows, cols = batch.shapes[k]
+                        np.testing.assert_array_equal(
+                            batch.ic_masks[k, :rows, :cols],
+                            expected[tag].ic_mask)
+                self.assertLess(parser.memory_cache.stats().nbytes,
+                                full.memory_cache.stats().nbytes * 0.7)
+        record = DicomContourParser(self.TEST_FOLDER, compact_masks=True)\
+            .record_list[0]
+        self.assertEqual(record.ic_mask.dtype, np.bool_)
+        np.testing.assert_array_equal(record.ic_mask,
+                                      full.record_list[0].data.ic_mask)
+
+    def test_volumes(self):
+        """Volumes should stack the slices of a patient in order
+        """
+        sync = DicomContourParser(self.TEST_FOLDER)
+        by_patient = {}
+        for record in sync.record_list:
+            by_patient.setdefault(record.patient_id, []).append(record)
+        for options in ({}, {'async_load': True, 'num_workers': 4},
+                        {'loader': 'process', 'num_workers': 2}):
+            with DicomContourParser(self.TEST_FOLDER, **options) as parser:
+                count = 0
+                for volume in parser.patient_iterator():
+                    records = sorted(by_patient[volume.patient_id],
+                                     key=lambda r: r.serial_id)
+                    self.assertEqual(len(volume), len(records))
+                    self.assertTrue(volume.images.flags.c_contiguous)
+                    self.assertEqual(list(volume.serial_ids),
+                                     [r.serial_id for r in records])
+                    for k in (0, len(records) // 2, len(records) - 1):
+                        rows, cols = volume.shapes[k]
+                        data = records[k].data
+                        np.testing.assert_array_equal(
+                            volume.images[k, :rows, :cols], data.dicom)
+                        np.testing.assert_array_equal(
+                            volume.oc_masks[k, :rows, :cols], data.oc_mask)
+                        np.testing.assert_array_equal(volume.ic_paths[k],
+                                                      data.ic_path)
+                    count += len(volume)
+                self.assertEqual(count, 1140)
+        # order by slice location, reversed here
+        parser = DicomContourParser(self.TEST_FOLDER)
+        meta = parser.table.metadata()
+        meta['slice_location'] = -parser.table.serial_id
+        patient_id = parser.id_list[1][0]
+        volume = parser.volume(patient_id, order='position',
+                               fields='dicom')
+        self.assertTrue(np.all(np.diff(volume.serial_ids) < 0))
+        self.assertIsNone(volume.ic_masks)
+        last = by_patient[patient_id][-1]
+        np.testing.assert_array_equal(volume.images[0], last.data.dicom)
+        # reused arrays
+        volumes = parser.patient_iterator(fields='ic_mask', reuse=True,
+                                          shuffle=True, seed=1)
+        first = next(volumes).ic_masks
+        self.assertTrue(np.shares_memory(next(volumes).ic_masks, first))
+        with self.assertRaises(ValueError):
+            parser.volume('nobody')
+        with self.assertRaises(ValueError):
+            parser.patient_rows('random')
+
+    def test_unknown_loader(self):
+        """Initializing with an unknown loader or conflicting memory options
+        should fail
+        """
+        with self.assertRaises(ValueError):
+            DicomContourParser(self.TEST_FOLDER, loader='gpu')
+        with self.assertRaises(ValueError):
+            DicomContourParser(self.TEST_FOLDER, loader='process',
+                               shared_memory=True, max_cache_bytes=10 ** 9)
+
+    def test_parallel_scan(self):
+        """Scanning on a thread pool should give the sequential order
+        """
+        serial = DicomContourParser(self.TEST_FOLDER, scan_workers=1)
+        parallel = DicomContourParser(self.TEST_FOLDER, scan_workers=4)
+        self.assertEqual(
+            [(r.patient_id, r.serial_id, r.filenames)
+             for r in serial.record_list],
+            [(r.patient_id, r.serial_id, r.filenames)
+             for r in parallel.record_list])
+        report = parallel.scan_report
+        self.assertEqual(report.num_patients, len(parallel.id_list))
+        self.assertEqual(report.num_records, 1140)
+        self.assertGreaterEqual(report.seconds, 0)
+
+    def test_record_views(self):
+        """Records are views over the parser's table and the iterator
+        shuffles an index permutation, not the record list.
+        """
+        parser = DicomContourParser(self.TEST_FOLDER)
+        before = [(r.patient_id, r.serial_id) for r in parser.record_list]
+        for _ in parser.random_shuffled_iterator(100):
+            pass
+        after = [(r.patient_id, r.serial_id) for r in parser.record_list]
+        self.assertEqual(before, after)
+        r1, r2 = parser.record_list[5], parser.record_list[5]
+        self.assertIsNone(r1._data)
+        r1.load_data()
+        self.assertIs(r1._data, r2._data)
+        r2.clear_data()
+        self.assertIsNone(r1._data)
+        with self.assertRaises(AttributeError):
+            r1.extra = 1
+
     def test_random_shuffle(self):
         """Each epoch should produce the same set of records at a random order
         """
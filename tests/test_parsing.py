@@ -49,12 +49,51 @@ class test_parsing(unittest.TestCase):
             coords_lst = parsing.parse_contour_file(filename)
             self.assertEqual(coords_lst, CONTOUR_DATA)
 
+    def test_parse_contour_array(self):
+        """Test parse_contour_array.
+
+        It should agree with parse_contour_file, blank lines included.
+        """
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            filename = os.path.join(tmpdirname, 'test_contour.txt')
+            with open(filename, 'w') as fp:
+                fp.write(CONTOUR_STR)
+            coords = parsing.parse_contour_array(filename)
+            self.assertEqual(coords.shape, (len(CONTOUR_DATA), 2))
+            self.assertEqual(coords.dtype, np.float64)
+            np.testing.assert_array_equal(coords, np.array(CONTOUR_DATA))
+            coords = parsing.parse_contour_array(filename, np.float32)
+            self.assertEqual(coords.dtype, np.float32)
+            # extra columns are ignored like in parse_contour_file
+            with open(filename, 'w') as fp:
+                fp.write('1.0 2.0 3.0\n\n4.0 5.0 6.0\n')
+            np.testing.assert_array_equal(
+                parsing.parse_contour_array(filename), [[1.0, 2.0],
+                                                        [4.0, 5.0]])
+
     def test_parse_dicom_file(self):
         """Test parse_dicom_file.
 
         Always pass for now. Ideally we should have a few known cases.
         """
 
+    def test_parse_dicom_metadata(self):
+        """Test parse_dicom_metadata.
+
+        It should describe the pixel data parse_dicom_file returns.
+        """
+        filename = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../final_data/dicoms/SCD0000101/1.dcm')
+        meta = parsing.parse_dicom_metadata(filename)
+        pixel_data = parsing.parse_dicom_file(filename)['pixel_data']
+        self.assertEqual((meta['rows'], meta['cols']), pixel_data.shape)
+        self.assertEqual(meta['dtype'], pixel_data.dtype)
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            filename = os.path.join(tmpdirname, 'not_dicom.dcm')
+            with open(filename, 'w') as fp:
+                fp.write(CONTOUR_STR)
+            self.assertIsNone(parsing.parse_dicom_metadata(filename))
+
     def test_poly_to_mask(self):
         """Test poly_to_mask.
 
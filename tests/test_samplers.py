@@ -0,0 +1,88 @@
+"""test_samplers.py
+
+Test the dicom_contour_parser.samplers module.
+
+"""
+
+
+import unittest
+import numpy as np
+from dicom_contour_parser import samplers
+
+
+class test_samplers(unittest.TestCase):
+    """Test the batch orders of the samplers
+    """
+
+    def test_shuffled_batches(self):
+        """Every record should be in exactly one batch
+        """
+        batches = samplers.shuffled_batches(103, 10)
+        self.assertEqual([len(b) for b in batches], [10] * 10 + [3])
+        self.assertEqual(sorted(np.concatenate(batches)), list(range(103)))
+
+    def test_shape_bucketed_batches(self):
+        """Batches should be homogeneous and cover every record once
+        """
+        rng = np.random.RandomState(0)
+        shapes = np.array([(256, 256), (192, 160), (512, 512)])[
+            rng.randint(0, 3, size=500)]
+        batches = samplers.shape_bucketed_batches(shapes, 32, rng)
+        for batch in batches:
+            self.assertTrue(np.all(shapes[batch] == shapes[batch[0]]))
+        self.assertEqual(sorted(np.concatenate(batches)), list(range(500)))
+        # at most one partial batch per bucket
+        self.assertLessEqual(sum(len(b) < 32 for b in batches), 3)
+        self.assertEqual(samplers.shape_bucketed_batches(
+            np.zeros((0, 2)), 32), [])
+
+    def test_balanced_batches(self):
+        """Every batch should hold the requested share of positives
+        """
+        positive = np.arange(0, 20)
+        negative = np.arange(20, 200)
+        batches = samplers.balanced_batches(positive, negative, 10, 0.3)
+        self.assertEqual(len(batches), 20)
+        for batch in batches:
+            self.assertEqual(len(batch), 10)
+            self.assertEqual(np.sum(batch < 20), 3)
+        drawn = np.concatenate(batches)
+        # the positives are oversampled evenly, the negatives drawn once
+        self.assertEqual(np.bincount(drawn[drawn < 20]).tolist(), [3] * 20)
+        self.assertEqual(len(set(drawn[drawn >= 20])), 140)
+        self.assertEqual(len(samplers.balanced_batches(
+            positive, negative, 10, num_batches=3)), 3)
+        with self.assertRaises(ValueError):
+            samplers.balanced_batches([], negative, 10, 0.5)
+
+    def test_partition(self):
+        """Shards should be disjoint, cover every record, and be balanced
+        """
+        rng = np.random.RandomState(1)
+        parts = samplers.partition(1000, 4, rng)
+        self.assertEqual([len(p) for p in parts], [250] * 4)
+        self.assertEqual(sorted(np.concatenate(parts)), list(range(1000)))
+        # the same random state gives the same partition
+        again = samplers.partition(1000, 4, np.random.RandomState(1))
+        for a, b in zip(parts, again):
+            np.testing.assert_array_equal(a, b)
+        groups = np.repeat(np.arange(20), 50)
+        parts = samplers.partition(1000, 4, rng, groups=groups)
+        self.assertEqual(sorted(np.concatenate(parts)), list(range(1000)))
+        for part in parts:
+            self.assertEqual(len(part), 250)
+            self.assertTrue(np.all(np.bincount(groups[part])[
+                np.unique(groups[part])] == 50))
+        weights = np.where(np.arange(1000) < 100, 10.0, 1.0)
+        parts = samplers.partition(1000, 4, rng, weights=weights)
+        for part in parts:
+            self.assertAlmostEqual(weights[part].sum(), 475, delta=10)
+        # heavy groups do not leave a shard empty
+        groups = np.repeat(np.arange(5), [400, 10, 300, 10, 280])
+        for seed in range(20):
+            parts = samplers.partition(1000, 5, np.random.RandomState(seed),
+                                       groups=groups)
+            self.assertTrue(all(len(part) for part in parts))
+            self.assertEqual(sorted(np.concatenate(parts)), list(range(1000)))
+        with self.assertRaises(ValueError):
+            samplers.partition(1000, 6, rng, groups=groups)
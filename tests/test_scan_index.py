@@ -0,0 +1,86 @@
+"""test_scan_index.py
+
+Test the dicom_contour_parser.scan_index module.
+
+"""
+
+
+import os
+import unittest
+import tempfile
+import os.path as opath
+from dicom_contour_parser import DicomContourParser
+
+
+class test_scan_index(unittest.TestCase):
+    """Test the incremental rescan with a ScanIndex
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = opath.join(self.tmpdir.name, 'data')
+        self.index_file = opath.join(self.tmpdir.name, 'index.json')
+        os.makedirs(self.root)
+        self.links = [('patient1', 'original1'), ('patient2', 'original2')]
+        for pid, oid in self.links:
+            self._touch('dicoms', pid, '1.dcm')
+            self._touch('dicoms', pid, '2.dcm')
+            self._touch('contourfiles', oid, 'i-contours',
+                        'IM-0001-0002-icontour-manual.txt')
+            os.makedirs(opath.join(self.root, 'contourfiles', oid,
+                                   'o-contours'))
+        self._write_links()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _touch(self, *parts):
+        """Create an empty file under the data folder, bumping the mtime of
+        its folder past the index's
+        """
+        filename = opath.join(self.root, *parts)
+        directory = opath.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        with open(filename, 'w'):
+            pass
+        st = os.stat(directory)
+        os.utime(directory, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def _write_links(self):
+        with open(opath.join(self.root, 'link.csv'), 'w') as f:
+            f.write('patient_id,original_id\n')
+            for pid, oid in self.links:
+                f.write('{},{}\n'.format(pid, oid))
+
+    def _records(self, parser):
+        return [(r.patient_id, r.serial_id, r.filenames)
+                for r in parser.record_list]
+
+    def test_incremental_rescan(self):
+        """Only changed and new patients should be scanned again
+        """
+        first = DicomContourParser(self.root, index_file=self.index_file)
+        self.assertEqual(first.scan_report.num_scanned, 2)
+        self.assertTrue(opath.isfile(self.index_file))
+        second = DicomContourParser(self.root, index_file=self.index_file)
+        self.assertEqual(second.scan_report.num_scanned, 0)
+        self.assertEqual(self._records(first), self._records(second))
+        # a new file in one patient's folder
+        self._touch('dicoms', 'patient2', '3.dcm')
+        third = DicomContourParser(self.root, index_file=self.index_file)
+        self.assertEqual(third.scan_report.num_scanned, 1)
+        self.assertEqual(len(third.record_list), 5)
+        self.assertEqual(
+            self._records(third),
+            self._records(DicomContourParser(self.root, scan_workers=1)))
+        # a new row in link.csv
+        self.links.append(('patient3', 'original3'))
+        self._touch('dicoms', 'patient3', '1.dcm')
+        self._touch('contourfiles', 'original3', 'i-contours', 'README')
+        os.makedirs(opath.join(self.root, 'contourfiles', 'original3',
+                               'o-contours'))
+        self._write_links()
+        fourth = DicomContourParser(self.root, index_file=self.index_file)
+        self.assertEqual(fourth.scan_report.num_scanned, 1)
+        self.assertEqual(len(fourth.record_list), 6)
+        self.assertEqual(fourth.record_list[5].patient_id, 'patient3')